@@ -0,0 +1,282 @@
+"""合并流程的基准测试：在本地生成合成的哔哩哔哩缓存目录，逐阶段计时并记录吞吐量和内存峰值。
+
+用法：
+    python -m bili_bench [--scales 10,1000,10000] [--duration 秒] [--size 宽x高] [--ffmpeg ffmpeg路径]
+                         [--mode copy|direct] [--engine ffmpeg|python] [--copy-engine auto|reflink|copy]
+                         [--jobs N] [--batch-size N]
+                         [--thumbnails N] [--workdir 目录] [--results bench_results.jsonl] [--keep]
+
+每个规模生成对应数量的缓存目录：用 ffmpeg 的 testsrc/sine 生成一对分片 MP4（视频、音频），
+加上 9 字节填充头后复制到每个目录，再依次测量 scan、copy、strip、merge、thumbnail、preview 各阶段。
+每个阶段在单独的子进程中运行，内存峰值只包含该阶段（ffmpeg 子进程单独统计）。
+结果追加到 --results 指定的 JSON Lines 文件，并与同一配置的上一次结果对比。
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bili_core import (
+    LibraryIndex, RunReport,
+    scan_library, copy_and_rename_m4s, delete_first_9_bytes, merge_m4s_to_mp4, extract_thumbnail
+)
+from bili_report import pad_display
+
+try:
+    import resource
+except ImportError:
+    # Windows 没有 resource 模块，不统计内存峰值
+    resource = None
+
+STAGES = ('scan', 'copy', 'strip', 'merge', 'thumbnail', 'preview')
+# 哔哩哔哩客户端在缓存文件开头写入的填充头
+CACHE_HEADER = b'000000000'
+# 结果表格的列名和显示宽度
+COLUMNS = (
+    ('目录数', 6), ('阶段', 9), ('耗时(秒)', 9), ('项目数', 6), ('项目/秒', 9),
+    ('MB/s', 7), ('内存(MB)', 8), ('ffmpeg内存(MB)', 14), ('对比上次', 8),
+)
+
+
+def _run(command):
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, text=True, errors='replace')
+    if result.returncode != 0:
+        raise RuntimeError(f"命令执行失败：{' '.join(command)}\n{result.stderr[-2000:]}")
+
+
+def make_fragments(ffmpeg_path, out_dir, duration, size):
+    """用 ffmpeg 的测试信号生成一对分片 MP4，返回 (视频路径, 音频路径)；已生成过时直接复用"""
+    video = os.path.join(out_dir, f"video_{size}_{duration}s.m4s")
+    audio = os.path.join(out_dir, f"audio_{duration}s.m4s")
+    # 与哔哩哔哩 DASH 缓存相同：每个关键帧一个 moof，文件开头是空的 moov，后面跟着覆盖全片的 sidx
+    movflags = ['-movflags', 'frag_keyframe+empty_moov+default_base_moof+global_sidx', '-f', 'mp4']
+    if not os.path.isfile(video):
+        _run([
+            ffmpeg_path, '-y', '-v', 'error', '-f', 'lavfi', '-i', f"testsrc=size={size}:rate=25",
+            '-t', str(duration), '-c:v', 'libx264', '-preset', 'veryfast', '-g', '25', '-pix_fmt', 'yuv420p',
+            *movflags, video + '.part'
+        ])
+        os.replace(video + '.part', video)
+    if not os.path.isfile(audio):
+        _run([
+            ffmpeg_path, '-y', '-v', 'error', '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100',
+            '-t', str(duration), '-c:a', 'aac', '-b:a', '64k', *movflags, audio + '.part'
+        ])
+        os.replace(audio + '.part', audio)
+    return video, audio
+
+
+def make_library(base_dir, count, video, audio):
+    """生成 count 个缓存目录，每个目录包含带填充头的视频流、音频流和 videoInfo.json"""
+    with open(video, 'rb') as f:
+        video_data = CACHE_HEADER + f.read()
+    with open(audio, 'rb') as f:
+        audio_data = CACHE_HEADER + f.read()
+    os.makedirs(base_dir, exist_ok=True)
+    for i in range(count):
+        folder = os.path.join(base_dir, str(100000 + i))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"{200000 + i}-1-30080.m4s"), 'wb') as f:
+            f.write(video_data)
+        with open(os.path.join(folder, f"{200000 + i}-1-30280.m4s"), 'wb') as f:
+            f.write(audio_data)
+        with open(os.path.join(folder, 'videoInfo.json'), 'w', encoding='utf-8') as f:
+            json.dump({'title': f"benchmark {i}", 'duration': 0}, f, ensure_ascii=False)
+
+
+def _peak_rss(who):
+    """进程（或其已结束的子进程中最大的那个）的内存峰值，单位字节"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux 上单位是 KB，macOS 上是字节
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_stage(stage, base_dir, options):
+    """在当前进程中执行一个阶段，返回计时结果"""
+    quiet = lambda message: None
+    report = RunReport()
+    index_path = os.path.join(os.path.dirname(base_dir), 'bench_library.db')
+    items = 0
+    start = time.perf_counter()
+    if stage == 'scan':
+        items = len(scan_library(base_dir, report=report))
+    elif stage == 'copy':
+        snapshot = scan_library(base_dir)
+        start = time.perf_counter()
+        copy_and_rename_m4s(base_dir, quiet, snapshot=snapshot, report=report, engine=options['copy_engine'])
+        items = len(snapshot)
+    elif stage == 'strip':
+        snapshot = scan_library(base_dir)
+        start = time.perf_counter()
+        delete_first_9_bytes(base_dir, quiet, snapshot=snapshot, report=report)
+        items = len(snapshot)
+    elif stage == 'merge':
+        snapshot = scan_library(base_dir)
+        start = time.perf_counter()
+        failed = merge_m4s_to_mp4(
+            base_dir, options['ffmpeg'], direct=options['mode'] == 'direct', jobs=options['jobs'], log=quiet,
+            snapshot=snapshot, engine=options['engine'], batch_size=options['batch_size'], report=report
+        )
+        if failed:
+            raise RuntimeError(f"{len(failed)} 个目录合并失败，例如 {failed[0]}")
+        items = len(snapshot)
+    elif stage == 'thumbnail':
+        merged = [f for f in scan_library(base_dir) if f.has_output][:options['thumbnails']]
+        cache_dir = tempfile.mkdtemp(prefix='bench_thumbs_', dir=os.path.dirname(base_dir))
+        start = time.perf_counter()
+        for folder in merged:
+            extract_thumbnail(options['ffmpeg'], folder.mp4_path, cache_dir, report)
+        items = len(merged)
+    elif stage == 'preview':
+        # 与界面的 load_previews 相同：借助索引扫描，筛出已合并的目录（第一次扫描用于建立索引，不计时）
+        index = LibraryIndex(index_path)
+        try:
+            scan_library(base_dir, index)
+            start = time.perf_counter()
+            items = len([f for f in scan_library(base_dir, index, report=report) if f.has_output])
+        finally:
+            index.close()
+    seconds = time.perf_counter() - start
+
+    summary = report.summary()
+    return {
+        'stage': stage,
+        'seconds': round(seconds, 6),
+        'items': items,
+        'bytes_read': sum(row['bytes_read'] for row in summary.values()),
+        'bytes_written': sum(row['bytes_written'] for row in summary.values()),
+        'peak_rss': _peak_rss(resource.RUSAGE_SELF) if resource else None,
+        'peak_rss_children': _peak_rss(resource.RUSAGE_CHILDREN) if resource else None,
+    }
+
+
+def measure(stage, base_dir, options):
+    """在新的子进程中执行一个阶段，内存峰值不受之前阶段的影响"""
+    command = [sys.executable, os.path.abspath(__file__), '_stage', stage, base_dir, json.dumps(options)]
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, text=True, errors='replace')
+    if result.returncode != 0:
+        raise RuntimeError(f"阶段 {stage} 执行失败：\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _git_commit():
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdin=subprocess.DEVNULL, capture_output=True, text=True
+        )
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def load_previous(results_path, config):
+    """同一配置（规模、阶段和合并参数都相同）上一次的结果：{(规模, 阶段): 记录}"""
+    previous = {}
+    if not os.path.isfile(results_path):
+        return previous
+    with open(results_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('config') == config:
+                previous[(entry['folders'], entry['stage'])] = entry
+    return previous
+
+
+def _format_cells(cells):
+    return '  '.join(pad_display(cell, width, i == 1) for i, (cell, (_, width)) in enumerate(zip(cells, COLUMNS)))
+
+
+def _format_mb(size):
+    return f"{size / 1024 / 1024:.0f}" if size else '-'
+
+
+def format_row(entry, before=None):
+    """一行结果；before 为同一配置上一次的结果时显示耗时的变化"""
+    mb = max(entry['bytes_read'], entry['bytes_written']) / 1024 / 1024
+    rate = entry['items'] / entry['seconds'] if entry['seconds'] > 0 else 0
+    change = ''
+    if before and before['seconds'] > 0:
+        change = f"{(entry['seconds'] - before['seconds']) / before['seconds'] * 100:+.1f}%"
+    return _format_cells((
+        entry['folders'], entry['stage'], f"{entry['seconds']:.3f}", entry['items'], f"{rate:.1f}",
+        f"{mb / entry['seconds']:.1f}" if entry['seconds'] > 0 and mb else '-',
+        _format_mb(entry['peak_rss']), _format_mb(entry['peak_rss_children']), change
+    ))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='bili_bench', description='哔哩哔哩缓存合并流程的基准测试')
+    parser.add_argument('--scales', default='10,1000,10000', help='逗号分隔的目录数量，默认 10,1000,10000')
+    parser.add_argument('--duration', type=int, default=2, help='每个合成视频的时长（秒），默认 2')
+    parser.add_argument('--size', default='320x180', help='合成视频的分辨率，默认 320x180')
+    parser.add_argument('--ffmpeg', default='ffmpeg', help='ffmpeg 可执行文件')
+    parser.add_argument('--mode', choices=('copy', 'direct'), default='copy', help='copy 时测量复制和去头阶段')
+    parser.add_argument('--engine', choices=('ffmpeg', 'python'), default='ffmpeg', help='合并引擎')
+    parser.add_argument('--copy-engine', choices=('auto', 'reflink', 'copy'), default='auto', help='复制阶段的方式')
+    parser.add_argument('--jobs', type=int, default=2, help='同时运行的合并进程数')
+    parser.add_argument('--batch-size', type=int, default=1, help='一个 ffmpeg 进程合并的目录数')
+    parser.add_argument('--thumbnails', type=int, default=50, help='每个规模最多生成多少张缩略图，默认 50')
+    parser.add_argument('--workdir', help='存放合成缓存的目录，默认使用系统临时目录')
+    parser.add_argument('--results', default='bench_results.jsonl', help='结果追加到的 JSON Lines 文件')
+    parser.add_argument('--keep', action='store_true', help='测试结束后保留生成的缓存目录')
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['_stage']:
+        # 子进程：执行单个阶段，结果以一行 JSON 输出
+        _, stage, base_dir, options = argv
+        print(json.dumps(run_stage(stage, base_dir, json.loads(options))))
+        return 0
+
+    args = build_parser().parse_args(argv)
+    scales = [int(n) for n in args.scales.split(',') if n.strip()]
+    options = {
+        'ffmpeg': args.ffmpeg, 'mode': args.mode, 'engine': args.engine, 'copy_engine': args.copy_engine,
+        'jobs': args.jobs, 'batch_size': args.batch_size, 'thumbnails': args.thumbnails,
+    }
+    config = dict(options, duration=args.duration, size=args.size)
+    del config['ffmpeg']
+    stages = [s for s in STAGES if args.mode == 'copy' or s not in ('copy', 'strip')]
+    previous = load_previous(args.results, config)
+    run = {
+        'run': time.strftime('%Y%m%d-%H%M%S'), 'commit': _git_commit(),
+        'python': platform.python_version(), 'platform': platform.platform(), 'config': config,
+    }
+
+    workdir = tempfile.mkdtemp(prefix='bili_bench_', dir=args.workdir)
+    print(f"🧪 合成缓存目录：{workdir}")
+    video, audio = make_fragments(args.ffmpeg, workdir, args.duration, args.size)
+    print(_format_cells([name for name, _ in COLUMNS]))
+    try:
+        for count in scales:
+            base_dir = os.path.join(workdir, f"library_{count}")
+            make_library(base_dir, count, video, audio)
+            for stage in stages:
+                entry = dict(run, folders=count, **measure(stage, base_dir, options))
+                print(format_row(entry, previous.get((count, stage))))
+                with open(args.results, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            if not args.keep:
+                shutil.rmtree(base_dir, ignore_errors=True)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print(f"📄 结果已追加到 {args.results}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""无界面的命令行入口，只依赖 bili_core，不导入 PyQt，适合服务器和定时任务批量合并。
+
+用法：
+    python -m bili_cli merge [--dir 缓存目录 ...] [--ffmpeg ffmpeg路径] [--output 输出目录] [--jobs N] [--mode direct|copy]
+                             [--engine ffmpeg|python] [--batch-size N] [--copy-engine auto|reflink|copy]
+                             [--cleanup keep|intermediates] [--concat-series]
+                             [--dedup off|skip|link] [--json]
+    python -m bili_cli watch [--dir 缓存目录 ...] [--ffmpeg ffmpeg路径] [--output 输出目录] [--interval 秒] [--json]
+
+未指定的参数从 config.ini 读取；--dir 可以重复指定，多个缓存目录同时扫描并放进同一个合并队列。--json 时每个事件输出为一行 JSON（progress/transfer/status/log/report/result/error），
+transfer 事件包含已写出/预计字节数、已处理/总时长、速度（字节/秒）和预计剩余秒数，
+report 事件为本次运行各阶段的耗时汇总（文本模式下输出为汇总表）。
+退出码：0 全部成功；1 有目录合并失败；2 参数或配置错误；130 被 Ctrl+C 或 SIGTERM 中断。
+"""
+import argparse
+import contextlib
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+from bili_core import (
+    MergeCancelled, LibraryIndex, RunReport,
+    get_config, get_settings, get_index_path, get_report_path, split_video_dirs,
+    scan_library, run_pipeline, watch_library, format_transfer
+)
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_INTERRUPTED = 130
+
+
+class Reporter:
+    """把进度、状态和日志输出为文本或 JSON Lines，多个合并线程可同时调用"""
+
+    def __init__(self, as_json, stream):
+        self.as_json = as_json
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        if self.as_json:
+            line = json.dumps({'event': event, 'time': round(time.time(), 3), **fields}, ensure_ascii=False)
+        elif event == 'progress':
+            line = f"[{fields['done']}/{fields['total']}] {fields['message']}"
+        elif event == 'result':
+            line = f"结果：{fields['status']}，共 {fields['total']} 个目录，{len(fields['failed'])} 个失败"
+        else:
+            line = fields.get('message', '')
+        with self._lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+    def progress(self, done, total, message):
+        self.emit('progress', done=done, total=total, message=message)
+
+    def status(self, message):
+        self.emit('status', message=message)
+
+    def log(self, message):
+        self.emit('log', message=message)
+
+    def transfer(self, stats):
+        self.emit(
+            'transfer',
+            bytes_done=stats.bytes_done, bytes_total=stats.bytes_total,
+            seconds_done=round(stats.seconds_done, 3), seconds_total=round(stats.seconds_total, 3),
+            rate=round(stats.rate), eta=None if stats.eta is None else round(stats.eta, 1),
+            message=format_transfer(stats)
+        )
+
+    def report(self, report):
+        if self.as_json:
+            self.emit('report', run=report.run_id, stages=report.summary())
+        else:
+            for line in report.format_summary():
+                self.log(line)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='bili_cli', description='哔哩哔哩缓存视频合并（命令行版）')
+    parser.add_argument('--config', default='config.ini', help='配置文件路径，默认 config.ini')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_common(sub):
+        sub.add_argument('--dir', action='append', help='哔哩哔哩缓存目录，可重复指定多个，默认取 config.ini 中的 video_dir')
+        sub.add_argument('--ffmpeg', help='ffmpeg 可执行文件，默认取 config.ini 中的 ffmpeg_path')
+        sub.add_argument('--output', help='mp4 输出目录，默认取 config.ini 中的 output_dir')
+        sub.add_argument('--jobs', type=int, help='同时运行的 ffmpeg 进程数')
+        sub.add_argument('--mode', choices=('direct', 'copy'), help='合并方式，见 config.ini 的 merge_mode')
+        sub.add_argument('--engine', choices=('ffmpeg', 'python'), help='合并引擎，见 config.ini 的 remux_engine')
+        sub.add_argument('--batch-size', type=int, help='一个 ffmpeg 进程合并的目录数')
+        sub.add_argument('--copy-engine', choices=('auto', 'reflink', 'copy'), help='生成 1/2.m4s 的方式，见 config.ini 的 copy_engine')
+        sub.add_argument('--cleanup', choices=('keep', 'intermediates'), help='中间文件保留策略，见 config.ini 的 cleanup')
+        sub.add_argument('--concat-series', action=argparse.BooleanOptionalAction, default=None,
+                         help='是否把分P合集合并为一个带章节的 mp4，默认取 config.ini 的 concat_series')
+        sub.add_argument('--dedup', choices=('off', 'skip', 'link'), help='内容相同的重复缓存如何处理，见 config.ini 的 dedup')
+        sub.add_argument('--no-index', action='store_true', help='不读写 library.db 索引，完整扫描目录')
+        sub.add_argument('--json', action='store_true', help='以 JSON Lines 输出进度，便于脚本解析')
+
+    add_common(subparsers.add_parser('merge', help='合并缓存目录中所有尚未合并的视频'))
+    watch = subparsers.add_parser('watch', help='持续监视缓存目录，下载完成后自动合并')
+    add_common(watch)
+    watch.add_argument('--interval', type=int, help='检查文件是否仍在增长的间隔（秒）')
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs 至少为 1")
+    reporter = Reporter(args.json, sys.stdout)
+
+    video_dir, ffmpeg_path = get_config(args.config)
+    settings = get_settings(args.config)
+    video_dir = ';'.join(args.dir) if args.dir else video_dir
+    ffmpeg_path = args.ffmpeg or ffmpeg_path
+    if args.output:
+        settings['output_dir'] = args.output
+    if args.jobs is not None:
+        settings['jobs'] = args.jobs
+    if args.mode:
+        settings['merge_mode'] = args.mode
+    if args.engine:
+        settings['remux_engine'] = args.engine
+    if args.batch_size:
+        settings['batch_size'] = args.batch_size
+    if args.copy_engine:
+        settings['copy_engine'] = args.copy_engine
+    if args.cleanup:
+        settings['cleanup'] = args.cleanup
+    if args.concat_series is not None:
+        settings['concat_series'] = args.concat_series
+    if args.dedup:
+        settings['dedup'] = args.dedup
+    if getattr(args, 'interval', None):
+        settings['watch_interval'] = args.interval
+
+    roots = split_video_dirs(video_dir)
+    missing = [root for root in roots if not os.path.isdir(root)]
+    if not roots or missing:
+        reporter.emit('error', message=f"❌ 未找到有效的视频目录：{'、'.join(missing) or video_dir}")
+        return EXIT_USAGE
+
+    # Ctrl+C 和 SIGTERM 都走取消流程：终止 ffmpeg 并清理未写完的文件
+    cancel_event = threading.Event()
+    for signum in (signal.SIGINT, getattr(signal, 'SIGTERM', None)):
+        if signum is not None:
+            signal.signal(signum, lambda *_: cancel_event.set())
+
+    index = None if args.no_index else LibraryIndex(get_index_path(args.config))
+
+    def save_report(report):
+        """写出运行报告并输出汇总表"""
+        try:
+            report.save(get_report_path(args.config) if settings['run_report'] else None, settings['metrics_file'])
+        except OSError as e:
+            reporter.log(f"⚠️ 无法写入运行报告：{e}")
+        reporter.report(report)
+
+    # JSON 模式下 stdout 只留给事件输出，其他零散的打印转到 stderr
+    quiet = contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext()
+    try:
+        with quiet:
+            if args.command == 'watch':
+                try:
+                    watch_library(video_dir, ffmpeg_path, settings, index, reporter.log, cancel_event, save_report)
+                except MergeCancelled:
+                    pass
+                return EXIT_OK
+
+            reporter.status("🔍 正在扫描缓存目录...")
+            report = RunReport()
+            snapshot = scan_library(video_dir, index, settings['output_dir'], report)
+            try:
+                failed = run_pipeline(
+                    video_dir, ffmpeg_path, settings,
+                    progress_callback=reporter.progress,
+                    status_callback=reporter.status,
+                    log=reporter.log,
+                    cancel_event=cancel_event,
+                    snapshot=snapshot,
+                    index=index,
+                    transfer_callback=reporter.transfer,
+                    report=report
+                )
+            except MergeCancelled:
+                reporter.emit('result', status='cancelled', total=len(snapshot), failed=[])
+                return EXIT_INTERRUPTED
+            finally:
+                save_report(report)
+    except Exception as e:
+        reporter.emit('error', message=f"⚠️ 处理过程中发生错误：{e}")
+        return EXIT_FAILED
+    finally:
+        if index is not None:
+            index.close()
+
+    reporter.emit('result', status='failed' if failed else 'ok', total=len(snapshot), failed=failed)
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
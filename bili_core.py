@@ -0,0 +1,1982 @@
+"""哔哩哔哩缓存合并的核心流程，不依赖 PyQt，可供图形界面和命令行共用"""
+import os
+import shutil
+import configparser
+import contextlib
+import subprocess
+import json
+import sqlite3
+import hashlib
+import sys
+import tempfile
+import time
+import threading
+from collections import Counter, namedtuple
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl，不支持写时复制克隆
+    fcntl = None
+
+from mp4box import probe_stream, header_cache, check_mp4
+from mp4remux import RemuxUnsupported, remux_fmp4
+from bili_report import RunReport
+
+# 流式复制时单次读写的块大小
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# Linux 的 FICLONE ioctl（_IOW(0x94, 9, int)）：在 btrfs/XFS 等写时复制文件系统上克隆文件，不复制数据
+FICLONE = 0x40049409
+# Windows 命令行最长约 32767 个字符，批量合并时单条命令不超过这个长度
+COMMAND_LENGTH_LIMIT = 30000
+
+# 流程中生成的中间文件，挑选原始缓存时需要排除
+GENERATED_M4S = ('1.m4s', '2.m4s', '1_delete8.m4s', '2_delete8.m4s')
+# 估算磁盘空间时额外保留的字节数，不把磁盘写到完全没有剩余
+DISK_RESERVE_BYTES = 256 * 1024 * 1024
+# 校验合并结果时允许的时长误差：至少 1 秒，较长的视频按时长的 1%
+DURATION_TOLERANCE = 0.01
+# 查找重复缓存时从每个流的开头、中间和结尾各读取的字节数
+FINGERPRINT_BLOCK = 64 * 1024
+
+# config.ini 中除目录外的可选配置及默认值
+DEFAULT_SETTINGS = {
+    # direct：ffmpeg 直接读取原始缓存并跳过文件头；copy：先生成 1/2.m4s 和 _delete8 中间文件
+    'merge_mode': 'direct',
+    # 同时运行的 ffmpeg 合并进程数
+    'jobs': 2,
+    # ffmpeg：调用 ffmpeg 合并；python：使用内置的纯 Python 合并，不支持的文件自动改用 ffmpeg
+    'remux_engine': 'ffmpeg',
+    # 一个 ffmpeg 进程合并的目录数，大量短视频时调大可减少进程启动开销
+    'batch_size': 1,
+    # 生成 1/2.m4s 的方式，auto：写时复制克隆、硬链接、复制依次尝试；reflink：不使用硬链接；copy：总是复制
+    'copy_engine': 'auto',
+    # keep：保留所有中间文件；intermediates：mp4 校验通过后删除 1/2.m4s 和 _delete8 中间文件
+    'cleanup': 'keep',
+    # 合并出的 mp4 存放的目录，留空时写在各自的缓存目录中；可以在另一块磁盘上
+    'output_dir': '',
+    # 把同一合集的分P（按 videoInfo.json 识别）直接合并为一个带章节的 mp4，不再逐个输出
+    'concat_series': False,
+    # 内容相同的重复缓存，off：照常合并；skip：跳过；link：硬链接已合并的 mp4
+    'dedup': 'off',
+    # 监视缓存目录，新缓存下载完成后自动合并
+    'watch': False,
+    # 监视模式下检查文件是否仍在增长的间隔（秒）
+    'watch_interval': 5,
+    # 每次合并后把各阶段的耗时记录追加到 config.ini 同目录的 run_report.jsonl
+    'run_report': True,
+    # Prometheus（node_exporter textfile）指标文件路径，留空时不写
+    'metrics_file': '',
+}
+
+class MergeCancelled(Exception):
+    """用户取消了正在进行的合并流程"""
+
+def _check_cancel(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise MergeCancelled()
+
+def _timed(report, stage, folder=None):
+    """report 为 RunReport 时记录该阶段的耗时，返回的 dict 用于填写读写字节数等；为 None 时不记录"""
+    return report.stage(stage, folder) if report is not None else contextlib.nullcontext({})
+
+def _remove_partial(path):
+    """删除被中断或失败的输出，避免下次被当成已完成的文件"""
+    if os.path.exists(path):
+        os.remove(path)
+
+# 各阶段先写到“正式文件名 + .part”，写完后再改名，扫描时不会把它当成 .m4s 或 .mp4
+PARTIAL_SUFFIX = '.part'
+
+def partial_path(path):
+    return path + PARTIAL_SUFFIX
+
+def _commit_partial(part_path, final_path):
+    """把写完的临时文件刷到磁盘后原子地改名为正式文件，断电或崩溃时不会留下半个正式文件"""
+    with open(part_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(part_path, final_path)
+
+def get_config(config_path='config.ini'):
+    config = configparser.ConfigParser()
+    config.read(config_path, encoding='utf-8')
+    video_dir = config.get('settings', 'video_dir', fallback=None)
+    ffmpeg_path = config.get('settings', 'ffmpeg_path', fallback='ffmpeg')
+    return video_dir, ffmpeg_path
+
+def split_video_dirs(video_dir):
+    """video_dir 可以用分号或换行分隔多个缓存目录（也可以直接传入列表），返回去重后的目录列表"""
+    parts = video_dir if isinstance(video_dir, (list, tuple)) else (video_dir or '').replace('\n', ';').split(';')
+    roots, seen = [], set()
+    for part in parts:
+        part = part.strip()
+        if not part:
+            continue
+        key = os.path.normcase(os.path.realpath(part))
+        if key not in seen:
+            seen.add(key)
+            roots.append(os.path.normpath(part))
+    return roots
+
+def get_settings(config_path='config.ini'):
+    """读取 DEFAULT_SETTINGS 中的可选配置，缺失或非法的值使用默认值"""
+    config = configparser.ConfigParser()
+    config.read(config_path, encoding='utf-8')
+    settings = dict(DEFAULT_SETTINGS)
+    for key, default in DEFAULT_SETTINGS.items():
+        try:
+            if isinstance(default, bool):
+                settings[key] = config.getboolean('settings', key, fallback=default)
+            elif isinstance(default, int):
+                settings[key] = config.getint('settings', key, fallback=default)
+            else:
+                settings[key] = config.get('settings', key, fallback=default).strip()
+        except ValueError:
+            print(f"⚠️ 配置项 {key} 无效，使用默认值 {default}")
+    return settings
+
+@dataclass
+class CacheFolder:
+    """一次扫描得到的单个缓存目录快照，各阶段写出新文件后同步更新"""
+    path: str
+    name: str
+    ctime: float
+    mtime: float
+    # 文件名 -> (大小, 创建时间)
+    files: dict = field(default_factory=dict)
+    # 最近一次合并失败
+    failed: bool = False
+    # 快照有变化，需要写回索引
+    dirty: bool = False
+    # 文件名 -> (探测时的大小, StreamInfo)，文件大小变化后重新探测
+    streams: dict = field(default_factory=dict, repr=False, compare=False)
+    # 新合并的 mp4 写到哪个目录，None 表示写在缓存目录中
+    output_dir: str = None
+    # 已合并到缓存目录之外的 mp4 路径
+    output_path: str = None
+    # videoInfo.json 中用到的字段（见 read_video_info），None 表示还没有读取
+    video_info: dict = field(default=None, repr=False, compare=False)
+    # 其他缓存目录中同名、没有被选用的副本路径
+    shadowed: list = field(default_factory=list, repr=False, compare=False)
+
+    @property
+    def state(self):
+        """处理进度：raw / renamed / stripped / merged / failed"""
+        if self.has_output:
+            return 'merged'
+        if self.failed:
+            return 'failed'
+        if self.has('1_delete8.m4s') and self.has('2_delete8.m4s'):
+            return 'stripped'
+        if self.has('1.m4s') and self.has('2.m4s'):
+            return 'renamed'
+        return 'raw'
+
+    def has(self, filename):
+        return filename in self.files
+
+    def file_path(self, filename):
+        return os.path.join(self.path, filename)
+
+    @property
+    def mp4_name(self):
+        return f"{self.name}.mp4"
+
+    @property
+    def mp4_path(self):
+        """已合并时为 mp4 实际所在的位置，否则为将要写出的位置"""
+        if self.output_path:
+            return self.output_path
+        if self.output_dir and not self.has(self.mp4_name):
+            return os.path.join(self.output_dir, self.mp4_name)
+        return self.file_path(self.mp4_name)
+
+    @property
+    def has_output(self):
+        return self.output_path is not None or self.has(self.mp4_name)
+
+    def record_output(self):
+        """合并完成后记录 mp4，写在输出目录时只记路径，不计入缓存目录的文件列表"""
+        if os.path.dirname(self.mp4_path) == self.path:
+            self.record(self.mp4_name)
+        else:
+            self.output_path = self.mp4_path
+            self.dirty = True
+
+    @property
+    def thumbnail_path(self):
+        for ext in ('jpg', 'png', 'jpeg'):
+            name = f"{self.name}.{ext}"
+            if name in self.files:
+                return self.file_path(name)
+        return None
+
+    def stream_info(self, filename):
+        """解析文件开头的 MP4 box 得到轨道类型、编码和时长，无法识别时返回 None"""
+        size = self.files[filename][0]
+        cached = self.streams.get(filename)
+        if cached is None or cached[0] != size:
+            try:
+                info = probe_stream(self.file_path(filename))
+            except OSError:
+                info = None
+            cached = self.streams[filename] = (size, info)
+        return cached[1]
+
+    def source_m4s(self):
+        """挑出原始缓存中的视频流和音频流，返回 [视频, 音频]。
+
+        按轨道类型配对，同一类型有多个文件（例如重新下载过）时取最大、最新的那个；
+        有文件无法识别时退回按创建时间取最早的两个文件。
+        """
+        m4s_files = [f for f in self.files if f.endswith('.m4s') and f not in GENERATED_M4S]
+        chosen = {}
+        for name in m4s_files:
+            info = self.stream_info(name)
+            if info is None or info.kind not in ('video', 'audio'):
+                continue
+            best = chosen.get(info.kind)
+            if best is None or self.files[name] > self.files[best]:
+                chosen[info.kind] = name
+        if 'video' in chosen and 'audio' in chosen:
+            return [chosen['video'], chosen['audio']]
+        return sorted(m4s_files, key=lambda f: self.files[f][1])[:2]
+
+    def header_size(self, filename):
+        """文件开头填充头的字节数（自动检测，不同客户端版本可能不同），无法识别时返回 None"""
+        info = self.stream_info(filename)
+        return None if info is None else info.header_size
+
+    def describe_stream(self, filename):
+        info = self.stream_info(filename)
+        if info is None:
+            return "未识别的流"
+        kind = {'video': '视频', 'audio': '音频'}.get(info.kind, info.kind)
+        duration = f"，{info.duration:.1f} 秒" if info.duration else ""
+        return f"{kind} {info.codec or '未知编码'}{duration}"
+
+    def record(self, filename):
+        st = os.stat(self.file_path(filename))
+        self.files[filename] = (st.st_size, st.st_ctime)
+        self.dirty = True
+
+    def forget(self, filename):
+        self.files.pop(filename, None)
+        self.dirty = True
+
+def get_index_path(config_path='config.ini'):
+    """索引数据库与 config.ini 放在同一目录"""
+    return os.path.join(os.path.dirname(os.path.abspath(config_path)), 'library.db')
+
+def get_report_path(config_path='config.ini'):
+    """运行报告（JSON Lines）与 config.ini 放在同一目录"""
+    return os.path.join(os.path.dirname(os.path.abspath(config_path)), 'run_report.jsonl')
+
+class LibraryIndex:
+    """持久化的缓存目录索引（SQLite），记录每个目录的指纹、文件列表和处理状态。
+
+    目录的修改时间没有变化且已经合并完成时，扫描直接复用索引中的记录，不再进入该目录，
+    启动和合并的耗时只与新增或变化的目录数量有关。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS folders (
+                    path TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    ctime REAL NOT NULL,
+                    mtime REAL NOT NULL,
+                    files TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    output_path TEXT,
+                    thumb_path TEXT,
+                    video_info TEXT
+                )
+            """)
+            # 旧版本的索引没有 video_info 列
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(folders)")}
+            if 'video_info' not in columns:
+                self._conn.execute("ALTER TABLE folders ADD COLUMN video_info TEXT")
+            # 每个目录各阶段的进度：started 表示开始后还没有完成（进程中断时会留下这条记录）
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS journal (
+                    path TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (path, stage)
+                )
+            """)
+            # 每个目录原始缓存的抽样指纹，signature 为计算时的文件名和大小，文件变化后重新计算
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS fingerprints (
+                    path TEXT PRIMARY KEY,
+                    signature TEXT NOT NULL,
+                    digest TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS fingerprints_digest ON fingerprints(digest)")
+            # 见过的 .m4s 填充头内容 -> 长度，客户端更换填充格式时只需扫描一次
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS headers (
+                    signature BLOB PRIMARY KEY,
+                    size INTEGER NOT NULL
+                )
+            """)
+        header_cache.update(self._conn.execute("SELECT signature, size FROM headers").fetchall())
+
+    def load(self, base_dir):
+        """返回 base_dir 下已索引的目录：{路径: CacheFolder}"""
+        base_dir = os.path.normpath(base_dir)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, name, ctime, mtime, files, state, output_path, video_info FROM folders"
+            ).fetchall()
+
+        folders = {}
+        for path, name, ctime, mtime, files, state, output_path, video_info in rows:
+            if os.path.dirname(os.path.normpath(path)) != base_dir:
+                continue
+            folder = CacheFolder(path, name, ctime, mtime, {k: tuple(v) for k, v in json.loads(files).items()})
+            folder.failed = state == 'failed'
+            if video_info is not None:
+                folder.video_info = json.loads(video_info)
+            # 目录自己的 mp4 已在文件列表中；合集文件可能写在第一个分P的目录里，需要单独记录
+            if output_path and output_path != os.path.join(path, f"{name}.mp4"):
+                folder.output_path = output_path
+            folders[path] = folder
+        return folders
+
+    def store(self, folders):
+        """写回目录的最新指纹和状态"""
+        rows = []
+        for folder in folders:
+            try:
+                folder.mtime = os.stat(folder.path).st_mtime
+            except OSError:
+                continue
+            state = folder.state
+            rows.append((
+                folder.path, folder.name, folder.ctime, folder.mtime,
+                json.dumps(folder.files, ensure_ascii=False), state,
+                folder.mp4_path if state == 'merged' else None,
+                folder.thumbnail_path,
+                None if folder.video_info is None else json.dumps(folder.video_info, ensure_ascii=False)
+            ))
+            folder.dirty = False
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO headers VALUES (?, ?)", header_cache.items()
+            )
+
+    def prune(self, base_dir, seen_paths):
+        """删除 base_dir 下已经不存在的目录记录"""
+        stale = [path for path in self.load(base_dir) if path not in seen_paths]
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM folders WHERE path = ?", [(p,) for p in stale])
+            self._conn.executemany("DELETE FROM journal WHERE path = ?", [(p,) for p in stale])
+            self._conn.executemany("DELETE FROM fingerprints WHERE path = ?", [(p,) for p in stale])
+
+    def journal_start(self, path, stage):
+        """记录目录开始执行某个阶段（copy / strip / merge）"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO journal VALUES (?, ?, 'started', ?)", (path, stage, time.time())
+            )
+
+    def journal_done(self, path, stage):
+        """记录阶段完成；合并完成后该目录已经处理完毕，删除它的全部记录"""
+        with self._lock, self._conn:
+            if stage == 'merge':
+                self._conn.execute("DELETE FROM journal WHERE path = ?", (path,))
+            else:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO journal VALUES (?, ?, 'done', ?)", (path, stage, time.time())
+                )
+
+    def interrupted(self):
+        """上次运行中开始了但没有完成的阶段：{路径: 阶段}"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, stage FROM journal WHERE status = 'started' ORDER BY updated"
+            ).fetchall()
+        return dict(rows)
+
+    def fingerprints(self):
+        """已计算过的指纹：{路径: (signature, digest)}"""
+        with self._lock:
+            rows = self._conn.execute("SELECT path, signature, digest FROM fingerprints").fetchall()
+        return {path: (signature, digest) for path, signature, digest in rows}
+
+    def store_fingerprints(self, rows):
+        """写入 [(路径, signature, digest), ...]"""
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)", rows)
+
+    def duplicate_counts(self):
+        """每个有重复的目录还有几份内容相同的缓存：{路径: 份数}"""
+        with self._lock:
+            # 先按 digest 分组找出重复的内容，再连回各自的路径，避免对每一行单独计数
+            rows = self._conn.execute("""
+                SELECT f.path, d.copies - 1
+                FROM fingerprints AS f
+                JOIN (SELECT digest, COUNT(*) AS copies FROM fingerprints GROUP BY digest HAVING COUNT(*) > 1) AS d
+                    ON d.digest = f.digest
+            """).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def _list_outputs(output_dir):
+    """输出目录中已有的 mp4 文件名；目录不存在时为空"""
+    try:
+        with os.scandir(output_dir) as entries:
+            return {entry.name for entry in entries if entry.name.endswith('.mp4')}
+    except OSError:
+        return set()
+
+def scan_library(video_dir, index=None, output_dir=None, report=None):
+    """用 os.scandir 一次性扫描缓存目录下的所有子目录。
+
+    返回按创建时间倒序（新视频在前）排列的 CacheFolder 列表，供复制、去头、合并和预览共用，
+    各阶段不再各自遍历目录和逐个 stat 文件。
+    video_dir 有多个缓存目录（见 split_video_dirs）时每个目录一个线程同时扫描，结果合并为一个列表；
+    不同缓存目录中同名的子目录是同一视频的多份缓存，只保留一份（见 _copy_rank），其余副本记在 shadowed 中。
+    传入 index 时，修改时间未变的已合并目录直接取自索引，新扫描的目录会写回索引。
+    output_dir 为设置中的输出目录，其中已有的 mp4 也算作已合并，新的合并结果写到这里。
+    report 为 RunReport 时记录每个缓存目录的扫描耗时。
+    """
+    output_dir = os.path.normpath(output_dir) if output_dir else None
+    outputs = _list_outputs(output_dir) if output_dir else set()
+    roots = split_video_dirs(video_dir)
+    if len(roots) == 1:
+        return _scan_root(roots[0], index, output_dir, outputs, report)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(roots))) as executor:
+        results = list(executor.map(lambda root: _scan_root(root, index, output_dir, outputs, report), roots))
+    chosen = {}
+    for folders in results:
+        for folder in folders:
+            current = chosen.get(folder.name)
+            if current is None:
+                chosen[folder.name] = folder
+                continue
+            keep, drop = (folder, current) if _copy_rank(folder) > _copy_rank(current) else (current, folder)
+            keep.shadowed = current.shadowed + [drop.path]
+            chosen[folder.name] = keep
+    return sorted(chosen.values(), key=lambda f: f.ctime, reverse=True)
+
+def _copy_rank(folder):
+    """同名副本的优先级：已合并的，其次音视频都在、文件头都能识别的，再按原始缓存的总大小和创建时间；相同时保留前面的目录"""
+    names = folder.source_m4s()
+    recognized = None not in (folder.header_size(name) for name in names)
+    size = sum(folder.files[name][0] for name in names)
+    newest = max((folder.files[name][1] for name in names), default=0.0)
+    return folder.has_output, len(names) >= 2, recognized, size, newest
+
+def _scan_root(base_dir, index, output_dir, outputs, report):
+    """扫描单个缓存目录，参数见 scan_library；outputs 为输出目录中已有的 mp4 文件名"""
+    with _timed(report, 'scan', base_dir) as timing:
+        known = index.load(base_dir) if index is not None else {}
+        folders = []
+        with os.scandir(base_dir) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                st = entry.stat()
+                cached = known.get(entry.path)
+                if cached is not None and cached.output_path:
+                    # 输出目录中的 mp4 被删除或移走时缓存目录本身不会变化，需要重新扫描
+                    listed = os.path.dirname(cached.output_path) == output_dir
+                    if not (os.path.basename(cached.output_path) in outputs if listed else os.path.isfile(cached.output_path)):
+                        cached = None
+                if cached is not None and cached.mtime == st.st_mtime and cached.state == 'merged':
+                    cached.output_dir = output_dir
+                    folders.append(cached)
+                    continue
+
+                folder = CacheFolder(entry.path, entry.name, st.st_ctime, st.st_mtime, output_dir=output_dir)
+                folder.failed = cached is not None and cached.failed
+                folder.dirty = True
+                if cached is not None and cached.output_path:
+                    # 合集文件写在第一个分P的目录中，会改变该目录的修改时间，输出仍在就仍算已合并
+                    folder.output_path = cached.output_path
+                elif folder.mp4_name in outputs:
+                    folder.output_path = os.path.join(output_dir, folder.mp4_name)
+                try:
+                    with os.scandir(entry.path) as children:
+                        for child in children:
+                            if child.is_file():
+                                child_st = child.stat()
+                                folder.files[child.name] = (child_st.st_size, child_st.st_ctime)
+                except OSError as e:
+                    print(f"⚠️ 无法读取目录 {entry.path}: {e}")
+                # videoInfo.json 没有变化时沿用索引中的字段，分P识别不必每次扫描都重新读取
+                previous = known.get(entry.path)
+                if (previous is not None and previous.video_info is not None
+                        and previous.files.get('videoInfo.json') == folder.files.get('videoInfo.json')):
+                    folder.video_info = previous.video_info
+                else:
+                    read_video_info(folder)
+                folders.append(folder)
+
+        if index is not None:
+            index.prune(base_dir, {f.path for f in folders})
+            index.store([f for f in folders if f.dirty])
+
+        folders.sort(key=lambda f: f.ctime, reverse=True)
+        timing['folders'] = len(folders)
+    return folders
+
+def copy_and_rename_m4s(directory, log=print, cancel_event=None, snapshot=None, journal=None, report=None,
+                        engine='auto'):
+    """把每个目录的视频流和音频流复制为 1.m4s / 2.m4s；journal 为 LibraryIndex 时记录阶段进度，
+    report 为 RunReport 时记录每个目录的耗时和读写字节数。
+    engine 为 clone_file 的复制方式，能克隆或硬链接时几乎不耗时，也不占用额外空间。
+    返回各复制方式使用的文件数，例如 {'reflink': 4}。"""
+    if snapshot is None:
+        snapshot = scan_library(directory)
+
+    strategies = {}
+    for folder in snapshot:
+        _check_cancel(cancel_event)
+        root = folder.path
+        if folder.has_output:
+            # 已合并的目录不再需要中间文件（开启 cleanup 时它们已被删除）
+            continue
+        if folder.has('1.m4s') and folder.has('2.m4s'):
+            log(f"目录 {root} 已有 1.m4s 和 2.m4s，跳过。")
+            continue
+
+        m4s_files = folder.source_m4s()
+
+        if len(m4s_files) == 0:
+            log(f"目录 {root} 没有找到可处理的 .m4s 文件，跳过。")
+            continue
+
+        if journal is not None:
+            journal.journal_start(root, 'copy')
+        with _timed(report, 'copy', root) as timing:
+            for index, old_name in enumerate(m4s_files, start=1):
+                old_path = os.path.join(root, old_name)
+                new_name = f"{index}.m4s"
+                new_path = os.path.join(root, new_name)
+                part_path = partial_path(new_path)
+
+                if folder.has(new_name):
+                    os.remove(new_path)
+                    folder.forget(new_name)
+
+                try:
+                    strategy = clone_file(old_path, part_path, engine, cancel_event)
+                    if strategy == 'hardlink':
+                        # 硬链接与原文件共用数据，不需要刷盘和复制时间戳
+                        os.replace(part_path, new_path)
+                    else:
+                        shutil.copystat(old_path, part_path)
+                        _commit_partial(part_path, new_path)
+                except BaseException:
+                    _remove_partial(part_path)
+                    raise
+                folder.record(new_name)
+                strategies[strategy] = strategies.get(strategy, 0) + 1
+                timing['strategy'] = strategy
+                if strategy in ('copy_file_range', 'copy'):
+                    timing['bytes_read'] = timing.get('bytes_read', 0) + folder.files[new_name][0]
+                    timing['bytes_written'] = timing.get('bytes_written', 0) + folder.files[new_name][0]
+                log(f"复制 {old_name} -> {new_name}（{folder.describe_stream(old_name)}，{strategy}）于目录 {root}")
+        if journal is not None:
+            journal.journal_done(root, 'copy')
+    if strategies:
+        log(f"📋 复制方式：{'，'.join(f'{name} {count} 个文件' for name, count in strategies.items())}")
+    return strategies
+
+def _reflink(src_path, dst_path):
+    """尝试用 FICLONE 克隆整个文件，文件系统不支持时删除创建的空文件并返回 False"""
+    if fcntl is None:
+        return False
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(dst_path)
+    return False
+
+def clone_file(src_path, dst_path, engine='auto', cancel_event=None):
+    """把 src_path 完整复制到 dst_path，返回实际使用的方式。
+
+    依次尝试 reflink（写时复制克隆，不占额外空间）、hardlink（硬链接，仅 engine 为 auto 时），
+    都不行时退回 copy_file_range（内核内复制）或 copy（按块复制）。engine 为 copy 时直接复制。
+    """
+    if engine in ('auto', 'reflink') and _reflink(src_path, dst_path):
+        return 'reflink'
+    if engine == 'auto':
+        try:
+            os.link(src_path, dst_path)
+            return 'hardlink'
+        except OSError:
+            pass
+    return copy_file_from_offset(src_path, dst_path, 0, cancel_event)
+
+def copy_file_from_offset(src_path, dst_path, offset=0, cancel_event=None):
+    """从 src_path 的 offset 处开始流式复制到 dst_path，内存占用只有一个块；
+    返回使用的方式：copy_file_range 或 copy"""
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        remaining = max(0, os.fstat(src.fileno()).st_size - offset)
+
+        # Linux 下优先交给内核按偏移复制，数据不经过用户态
+        if hasattr(os, 'copy_file_range') and remaining > 0:
+            try:
+                while remaining > 0:
+                    _check_cancel(cancel_event)
+                    copied = os.copy_file_range(
+                        src.fileno(), dst.fileno(), min(remaining, COPY_CHUNK_SIZE), offset
+                    )
+                    if copied == 0:
+                        break
+                    offset += copied
+                    remaining -= copied
+                return 'copy_file_range'
+            except OSError:
+                # 只有一个字节都没复制时才回退，否则说明是真正的读写错误
+                if dst.tell() > 0:
+                    raise
+
+        src.seek(offset)
+        while True:
+            _check_cancel(cancel_event)
+            chunk = src.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            dst.write(chunk)
+    return 'copy'
+
+def delete_first_9_bytes(directory, log=print, cancel_event=None, snapshot=None, journal=None, report=None):
+    """去掉 1.m4s/2.m4s 开头的填充头，生成 _delete8 文件；填充长度按文件内容自动检测。
+    report 为 RunReport 时记录每个目录的耗时和读写字节数"""
+    if snapshot is None:
+        snapshot = scan_library(directory)
+
+    for folder in snapshot:
+        if folder.has_output:
+            continue
+        pending = [
+            f for f in ('1.m4s', '2.m4s')
+            if folder.has(f) and not folder.has(f.replace('.m4s', '_delete8.m4s'))
+        ]
+        if journal is not None and pending:
+            journal.journal_start(folder.path, 'strip')
+        with _timed(report if pending else None, 'strip', folder.path) as timing:
+            for filename in ('1.m4s', '2.m4s'):
+                if not folder.has(filename):
+                    continue
+                _check_cancel(cancel_event)
+                original_path = folder.file_path(filename)
+                new_filename = filename.replace('.m4s', '_delete8.m4s')
+                new_path = folder.file_path(new_filename)
+                part_path = partial_path(new_path)
+
+                if folder.has(new_filename):
+                    log(f"跳过已存在的文件：{new_path}")
+                    continue
+
+                header_size = folder.header_size(filename)
+                if header_size is None:
+                    # 识别不出 MP4 结构时不猜测长度，避免写出损坏的文件
+                    log(f"⚠️ 无法识别文件头，跳过：{original_path}")
+                    continue
+
+                try:
+                    # 一次顺序读写完成去头，不再整文件读入内存
+                    copy_file_from_offset(original_path, part_path, header_size, cancel_event)
+                    shutil.copystat(original_path, part_path)
+                    _commit_partial(part_path, new_path)
+                    folder.record(new_filename)
+                    timing['bytes_read'] = timing.get('bytes_read', 0) + folder.files[filename][0]
+                    timing['bytes_written'] = timing.get('bytes_written', 0) + folder.files[new_filename][0]
+                    log(f"成功复制并处理：{new_path}")
+                except Exception as e:
+                    # 删掉写了一半的文件，避免下次被当成已处理而跳过
+                    _remove_partial(part_path)
+                    if isinstance(e, MergeCancelled):
+                        raise
+                    timing['ok'] = False
+                    log(f"处理文件时出错：{original_path}")
+                    log(str(e))
+        if journal is not None and pending and folder.has('1_delete8.m4s') and folder.has('2_delete8.m4s'):
+            journal.journal_done(folder.path, 'strip')
+
+def _terminate(process, close_pipes=True):
+    """终止 ffmpeg，等待片刻后仍未退出则强制结束。
+
+    close_pipes 时关闭管道（其子进程可能仍占用着管道）；管道正被读取线程使用时由读取线程自己关闭。
+    """
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    if close_pipes:
+        process.stdout.close()
+        process.stderr.close()
+
+def _read_progress(stream, on_progress):
+    """解析 ffmpeg -progress 输出的 key=value 行，每个块结束（progress=...）时回调一次，读完后关闭管道"""
+    fields = {}
+    with stream:
+        for line in stream:
+            key, _, value = line.strip().partition('=')
+            fields[key] = value
+            if key != 'progress':
+                continue
+            try:
+                size = int(fields.get('total_size', '0'))
+                seconds = int(fields.get('out_time_us', '0')) / 1_000_000
+            except ValueError:
+                # 刚启动时部分字段为 N/A
+                continue
+            on_progress(size, max(0.0, seconds))
+
+def _read_all(stream, parts):
+    with stream:
+        parts.append(stream.read())
+
+def run_ffmpeg(command, cancel_event=None, on_progress=None):
+    """运行 ffmpeg 并收集输出，Windows 下不弹出控制台窗口。
+
+    cancel_event 被设置时终止 ffmpeg 进程并抛出 MergeCancelled。
+    传入 on_progress 时让 ffmpeg 通过 -progress 把进度写到 stdout，
+    运行期间在读取线程中反复调用 on_progress(已写出字节数, 已处理到的秒数)。
+    """
+    if on_progress is not None:
+        command = [command[0], "-progress", "pipe:1", "-nostats", *command[1:]]
+    kwargs = {}
+    if sys.platform == "win32":
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        kwargs['startupinfo'] = startupinfo
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+        **kwargs
+    )
+
+    if on_progress is None:
+        poll_interval = None if cancel_event is None else 0.2
+        while True:
+            try:
+                stdout, stderr = process.communicate(timeout=poll_interval)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_event.is_set():
+                    _terminate(process)
+                    raise MergeCancelled()
+        return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+    # stdout 是进度流，边运行边解析；stderr 在另一个线程读完，避免管道写满卡住 ffmpeg
+    stderr_parts = []
+    readers = [
+        threading.Thread(target=_read_progress, args=(process.stdout, on_progress), daemon=True),
+        threading.Thread(target=_read_all, args=(process.stderr, stderr_parts), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    while True:
+        try:
+            process.wait(timeout=0.2)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel_event is not None and cancel_event.is_set():
+                _terminate(process, close_pipes=False)
+                raise MergeCancelled()
+    for reader in readers:
+        reader.join()
+    return subprocess.CompletedProcess(command, process.returncode, '', ''.join(stderr_parts))
+
+class TransferStats(namedtuple('TransferStats', 'bytes_done bytes_total seconds_done seconds_total elapsed')):
+    """合并阶段的累计进度：已写出/预计写出的字节数，已处理/全部的视频时长（秒），已用时间（秒）"""
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """平均写出速度（字节/秒）"""
+        return self.bytes_done / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """按平均速度估算的剩余秒数，还没有数据时为 None"""
+        if self.rate <= 0:
+            return None
+        return max(0.0, self.bytes_total - self.bytes_done) / self.rate
+
+    @property
+    def fraction(self):
+        return min(1.0, self.bytes_done / self.bytes_total) if self.bytes_total > 0 else 0.0
+
+def _format_clock(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}" if hours else f"{rest // 60:02d}:{rest % 60:02d}"
+
+def format_transfer(stats):
+    """把 TransferStats 格式化为状态栏和命令行使用的一行文字"""
+    mb = 1024 * 1024
+    text = (f"📦 {stats.bytes_done / mb:.1f}/{stats.bytes_total / mb:.1f} MB"
+            f"  ⏱️ {_format_clock(stats.seconds_done)}/{_format_clock(stats.seconds_total)}"
+            f"  🚀 {stats.rate / mb:.1f} MB/s")
+    if stats.eta is not None:
+        text += f"  ⌛ 剩余 {_format_clock(stats.eta)}"
+    return text
+
+class MergeProgress:
+    """汇总所有并发合并任务的字节和时长进度，多个线程可同时调用。
+
+    正在运行的任务按 key（输出文件或一批输出）记录最新的进度，完成后计入累计值；
+    失败或实际大小与预估不同的任务会修正总量，进度最终正好到达 100%。
+    回调按 interval 秒节流，ffmpeg 每个进度块都调用 update 也不会刷屏。
+    """
+
+    def __init__(self, bytes_total, seconds_total, callback, interval=0.5):
+        self.callback = callback
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._bytes_total = bytes_total
+        self._seconds_total = seconds_total
+        self._bytes_done = 0
+        self._seconds_done = 0.0
+        # key -> (已写出字节数, 已处理秒数)
+        self._active = {}
+        self._start = time.monotonic()
+        self._last_emit = 0.0
+
+    def _stats(self):
+        active_bytes = sum(size for size, _ in self._active.values())
+        active_seconds = sum(seconds for _, seconds in self._active.values())
+        return TransferStats(
+            self._bytes_done + active_bytes, self._bytes_total,
+            min(self._seconds_done + active_seconds, self._seconds_total), self._seconds_total,
+            time.monotonic() - self._start
+        )
+
+    def _emit(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_emit < self.interval:
+            return None
+        self._last_emit = now
+        return self._stats()
+
+    def update(self, key, size, seconds):
+        with self._lock:
+            self._active[key] = (size, seconds)
+            stats = self._emit()
+        if stats is not None:
+            self.callback(stats)
+
+    def complete(self, key, results):
+        """key 对应的进程结束；results 为 [(MergeTask, 是否成功), ...]，可以为空（整批失败后改为逐个合并）"""
+        with self._lock:
+            self._active.pop(key, None)
+            for task, ok in results:
+                actual = os.path.getsize(task.output_file) if ok and os.path.isfile(task.output_file) else 0
+                self._bytes_total += actual - task.size
+                self._bytes_done += actual
+                if ok:
+                    self._seconds_done += task.duration
+                else:
+                    self._seconds_total -= task.duration
+            stats = self._emit(force=True)
+        self.callback(stats)
+
+# 一个待合并的目录：各输入的 ffmpeg 参数、输出文件、内置合并用的 sources，以及预计的输出大小和时长
+MergeTask = namedtuple('MergeTask', 'folder inputs output_file sources size duration')
+
+def build_merge_command(ffmpeg_path, tasks):
+    """生成合并命令。tasks 为 [(各输入的参数列表, 输出文件), ...]。
+
+    只有一个目录时与逐个合并的命令相同；多个目录时每个输出用 -map 选取属于自己的输入。
+    """
+    command = [ffmpeg_path]
+    for inputs, _ in tasks:
+        for args in inputs:
+            command += args
+    # 输出写到 .part 临时文件，无法从扩展名推断格式，需显式指定 -f mp4
+    if len(tasks) == 1:
+        return command + ["-c", "copy", "-f", "mp4", tasks[0][1]]
+
+    index = 0
+    for inputs, output_file in tasks:
+        for _ in inputs:
+            command += ["-map", str(index)]
+            index += 1
+        command += ["-c", "copy", "-f", "mp4", output_file]
+    return command
+
+def _mark_merged(folder, output_file, log=print, journal=None):
+    _commit_partial(partial_path(output_file), output_file)
+    folder.failed = False
+    folder.record_output()
+    if journal is not None:
+        journal.journal_done(folder.path, 'merge')
+    log(f"✅ 成功合并：{output_file}")
+
+def _mark_failed(folder, output_file, detail, log=print):
+    log(f"❌ 合并失败：{folder.path}\n{detail}")
+    _remove_partial(partial_path(output_file))
+    folder.failed = True
+    folder.dirty = True
+
+def _merge_folder(task, log=print, cancel_event=None, progress=None, ffmpeg_path='ffmpeg', journal=None, report=None):
+    """合并单个目录；task.sources 不为 None 时先尝试内置合并，不支持时再调用 ffmpeg"""
+    _check_cancel(cancel_event)
+    folder, output_file = task.folder, task.output_file
+    part_path = partial_path(output_file)
+    log(f"Merging: {folder.path}")
+    if journal is not None:
+        journal.journal_start(folder.path, 'merge')
+    on_progress = None
+    if progress is not None:
+        on_progress = lambda size, seconds: progress.update(output_file, size, min(seconds, task.duration))
+
+    ok = False
+    with _timed(report, 'merge', folder.path) as timing:
+        timing['bytes_read'] = task.size
+        try:
+            if task.sources is not None:
+                try:
+                    remux_fmp4(task.sources, part_path, lambda: _check_cancel(cancel_event), on_progress)
+                except RemuxUnsupported as e:
+                    _remove_partial(part_path)
+                    log(f"ℹ️ 内置合并无法处理（{e}），改用 ffmpeg：{folder.path}")
+                else:
+                    timing['engine'] = 'python'
+                    _mark_merged(folder, output_file, log, journal)
+                    ok = True
+                    return True
+
+            timing['engine'] = 'ffmpeg'
+            command = build_merge_command(ffmpeg_path, [(task.inputs, part_path)])
+            result = run_ffmpeg(command, cancel_event, on_progress)
+            timing['exit_code'] = result.returncode
+            if result.returncode == 0:
+                _mark_merged(folder, output_file, log, journal)
+                ok = True
+                return True
+            _mark_failed(folder, output_file, result.stderr, log)
+            return False
+        except BaseException:
+            _remove_partial(part_path)
+            raise
+        finally:
+            timing['ok'] = ok
+            if ok:
+                timing['bytes_written'] = os.path.getsize(output_file)
+            if progress is not None:
+                progress.complete(output_file, [(task, ok)])
+
+def _merge_batch(ffmpeg_path, batch, log=print, cancel_event=None, progress=None, journal=None, report=None):
+    """合并一批目录（MergeTask 列表），返回 [(folder, 是否成功), ...]。
+
+    多个目录时共用一个 ffmpeg 进程；整批失败时删除这批的所有输出，
+    再逐个目录单独合并，每个目录仍得到各自的结果。
+    report 为 RunReport 时批量合并的耗时按目录数平均记到每个目录。
+    """
+    if len(batch) == 1:
+        return [(batch[0].folder, _merge_folder(batch[0], log, cancel_event, progress, ffmpeg_path, journal, report))]
+
+    _check_cancel(cancel_event)
+    parts = [partial_path(task.output_file) for task in batch]
+    key = tuple(parts)
+    on_progress = None
+    if progress is not None:
+        # 多个输出时 ffmpeg 报告的时间跟着最快的流走，时长进度改按已写出字节的比例估算
+        batch_size = sum(task.size for task in batch) or 1
+        batch_duration = sum(task.duration for task in batch)
+        on_progress = lambda size, _: progress.update(key, size, batch_duration * min(1.0, size / batch_size))
+    log(f"Merging: {len(batch)} 个目录（批量）：{', '.join(task.folder.name for task in batch)}")
+    if journal is not None:
+        for task in batch:
+            journal.journal_start(task.folder.path, 'merge')
+    started = time.perf_counter()
+    try:
+        result = run_ffmpeg(
+            build_merge_command(ffmpeg_path, [(task.inputs, part) for task, part in zip(batch, parts)]),
+            cancel_event, on_progress
+        )
+    except BaseException:
+        for part in parts:
+            _remove_partial(part)
+        raise
+
+    ok = result.returncode == 0 and all(os.path.isfile(p) and os.path.getsize(p) > 0 for p in parts)
+    if report is not None:
+        seconds = (time.perf_counter() - started) / len(batch)
+        for task, part in zip(batch, parts):
+            report.add({
+                'stage': 'merge', 'folder': task.folder.path, 'seconds': seconds, 'ok': ok,
+                'bytes_read': task.size, 'bytes_written': os.path.getsize(part) if ok else 0,
+                'exit_code': result.returncode, 'engine': 'ffmpeg', 'batch': len(batch)
+            })
+
+    if ok:
+        for task in batch:
+            _mark_merged(task.folder, task.output_file, log, journal)
+        if progress is not None:
+            progress.complete(key, [(task, True) for task in batch])
+        return [(task.folder, True) for task in batch]
+
+    for part in parts:
+        _remove_partial(part)
+    if progress is not None:
+        progress.complete(key, [])
+    log(f"⚠️ 批量合并失败，改为逐个目录合并：{', '.join(task.folder.name for task in batch)}")
+    return [
+        (task.folder, _merge_folder(task, log, cancel_event, progress, ffmpeg_path, journal, report))
+        for task in batch
+    ]
+
+def _group_batches(pending, batch_size):
+    """按提交顺序把待合并的目录分成每批最多 batch_size 个，且单条命令不超过 COMMAND_LENGTH_LIMIT"""
+    batches = []
+    current = []
+    length = 0
+    for task in pending:
+        size = sum(len(arg) + 3 for args in task.inputs for arg in args) + len(task.output_file) + 32
+        if current and (len(current) >= batch_size or length + size > COMMAND_LENGTH_LIMIT):
+            batches.append(current)
+            current = []
+            length = 0
+        current.append(task)
+        length += size
+    if current:
+        batches.append(current)
+    return batches
+
+def _interleave_roots(tasks):
+    """按所在的缓存目录轮流排列任务，同一缓存目录内仍保持原来的顺序"""
+    groups = {}
+    for task in tasks:
+        groups.setdefault(os.path.dirname(task.folder.path), []).append(task)
+    if len(groups) < 2:
+        return tasks
+    return [task for row in zip_longest(*groups.values()) for task in row if task is not None]
+
+def _plan_task(folder, names, header_sizes, inputs, sources):
+    """预计的输出大小（去掉填充头后的输入之和）和时长（各流中最长的）"""
+    size = sum(max(0, folder.files[name][0] - header_size) for name, header_size in zip(names, header_sizes))
+    durations = [folder.stream_info(name).duration for name in names if folder.stream_info(name)]
+    duration = max([d for d in durations if d] or [0.0])
+    return MergeTask(folder, inputs, folder.mp4_path, sources, size, duration)
+
+def merge_m4s_to_mp4(base_dir, ffmpeg_path, progress_callback=None, direct=False, jobs=1,
+                     log=print, cancel_event=None, snapshot=None, engine='ffmpeg', batch_size=1,
+                     transfer_callback=None, journal=None, report=None, progress=None):
+    """合并每个子目录的音视频流，返回合并失败的目录列表。
+
+    direct 为 True 时不依赖 1_delete8.m4s/2_delete8.m4s，
+    而是让 ffmpeg 直接读取原始缓存文件并跳过开头的填充字节，只写出最终的 mp4。
+    jobs 为同时运行的 ffmpeg 进程数；任务按新视频在前的顺序提交，
+    progress_callback 在调用线程中按目录完成的先后回调。
+    cancel_event 被设置后不再启动新的合并，正在运行的 ffmpeg 会被终止并删除其未写完的输出。
+    snapshot 为 scan_library 的结果，未传入时重新扫描 base_dir。
+    engine 为 'python' 时先用内置的纯 Python 合并，处理不了的目录再交给 ffmpeg。
+    batch_size 大于 1 时（仅 ffmpeg 引擎）每个 ffmpeg 进程一次合并多个目录。
+    transfer_callback(TransferStats) 在合并过程中（工作线程里）按字节和视频时长汇报整体进度；
+    传入 progress（MergeProgress）时进度计入其中，用于调用方分多次合并时汇总为一个整体进度。
+    每个输出先写到 .part 临时文件，成功后再改名；journal 为 LibraryIndex 时记录每个目录的合并进度。
+    report 为 RunReport 时记录每个目录的合并耗时、读写字节数、使用的引擎和 ffmpeg 退出码。
+    """
+    if snapshot is None:
+        snapshot = scan_library(base_dir)
+
+    total = len(snapshot)
+    done = 0
+    failed = []
+    pending = []
+
+    for folder in snapshot:
+        folder_path = folder.path
+        output_file = folder.mp4_path
+
+        task = None
+        if folder.has_output:
+            log(f"⚠️ 文件已存在，跳过合并：{output_file}")
+        elif direct:
+            names = folder.source_m4s()
+            header_sizes = [folder.header_size(f) for f in names]
+            if len(names) < 2:
+                log(f"⚠️ 缺少可合并的原始 .m4s 缓存，{folder_path}")
+            elif None in header_sizes:
+                log(f"⚠️ 无法识别缓存文件头，跳过：{folder_path}")
+            else:
+                log(f"🎞️ {folder.name}：{' + '.join(folder.describe_stream(f) for f in names)}")
+                # 缓存文件带有填充头，需显式指定封装格式，探测才会从偏移处开始
+                inputs = [
+                    ["-f", "mp4", "-skip_initial_bytes", str(header_size), "-i", folder.file_path(name)]
+                    for name, header_size in zip(names, header_sizes)
+                ]
+                sources = [(folder.file_path(name), size) for name, size in zip(names, header_sizes)]
+                task = _plan_task(folder, names, header_sizes, inputs, sources)
+        else:
+            if folder.has('1_delete8.m4s') and folder.has('2_delete8.m4s'):
+                names = ['1_delete8.m4s', '2_delete8.m4s']
+                inputs = [["-i", folder.file_path(name)] for name in names]
+                sources = [(folder.file_path(name), 0) for name in names]
+                task = _plan_task(folder, names, [0, 0], inputs, sources)
+            else:
+                log(f"⚠️ 缺少 1_delete8.m4s 或 2_delete8.m4s，{folder_path}")
+
+        if task is None:
+            done += 1
+            if progress_callback:
+                progress_callback(done, total, f"✨ 正在处理: {folder.name}")
+            continue
+        pending.append(task if engine == 'python' else task._replace(sources=None))
+
+    if progress is None and transfer_callback is not None and pending:
+        progress = MergeProgress(
+            sum(task.size for task in pending), sum(task.duration for task in pending), transfer_callback
+        )
+
+    # 有多个缓存目录时轮流从各目录取任务，让同时运行的合并分散到不同磁盘上
+    pending = _interleave_roots(pending)
+    # 内置合并本来就不启动进程，不需要分批
+    batches = _group_batches(pending, 1 if engine == 'python' else max(1, batch_size))
+
+    # 线程池按提交顺序取任务，新视频仍然最先开始合并
+    executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+    try:
+        futures = {
+            executor.submit(_merge_batch, ffmpeg_path, batch, log, cancel_event, progress, journal, report): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                results = future.result()
+            except MergeCancelled:
+                raise
+            except Exception as e:
+                log(f"❌ 合并失败：{', '.join(task.folder.path for task in batch)}\n{e}")
+                results = [(task.folder, False) for task in batch]
+            for folder, ok in results:
+                if not ok:
+                    failed.append(folder.path)
+                done += 1
+                if progress_callback:
+                    progress_callback(done, total, f"✨ 已处理: {folder.name}")
+    finally:
+        # 取消时丢弃尚未开始的任务，并等待正在运行的 ffmpeg 退出清理
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    _check_cancel(cancel_event)
+    return failed
+
+def fingerprint_stream(path, offset=0):
+    """按去掉填充头后的大小和开头、中间、结尾各 FINGERPRINT_BLOCK 字节计算指纹，不读取整个文件"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size - offset
+        digest.update(str(size).encode())
+        for pos in sorted({0, max(0, (size - FINGERPRINT_BLOCK) // 2), max(0, size - FINGERPRINT_BLOCK)}):
+            f.seek(offset + pos)
+            digest.update(f.read(FINGERPRINT_BLOCK))
+    return digest.hexdigest()
+
+def _fingerprint_folder(folder):
+    """目录中视频流和音频流的指纹，无法识别时返回 None"""
+    names = folder.source_m4s()
+    header_sizes = [folder.header_size(name) for name in names]
+    if len(names) < 2 or None in header_sizes:
+        return None
+    try:
+        streams = [fingerprint_stream(folder.file_path(name), size) for name, size in zip(names, header_sizes)]
+    except OSError:
+        return None
+    return hashlib.sha1('|'.join(streams).encode()).hexdigest()
+
+def find_duplicates(snapshot, library=None, index=None):
+    """找出 snapshot 中与其他缓存内容相同、尚未合并的目录，返回 [(重复的目录, 保留的目录), ...]。
+
+    library 为完整的扫描结果（监视模式下 snapshot 只有新下载的目录），用来和已合并的目录比较。
+    先按原始 .m4s 的大小分组，只有大小完全相同的目录才读取抽样指纹；
+    指纹记入 index，文件没有变化时不再重新读取。每组保留已合并的目录，都未合并时保留最早的缓存。
+    """
+    folders = {folder.path: folder for folder in library or ()}
+    folders.update((folder.path, folder) for folder in snapshot)
+    # 原始 .m4s 的文件名和大小，与监视模式判断下载完成用的相同
+    signatures = {path: StabilityTracker.signature(folder) for path, folder in folders.items()}
+    by_size = {}
+    for folder in folders.values():
+        sizes = tuple(sorted(size for _, size in signatures[folder.path]))
+        if len(sizes) >= 2:
+            by_size.setdefault(sizes, []).append(folder)
+
+    known = index.fingerprints() if index is not None else {}
+    wanted = {folder.path for folder in snapshot if not folder.has_output}
+    by_digest = {}
+    computed = []
+    for group in by_size.values():
+        if len(group) < 2 or not any(folder.path in wanted for folder in group):
+            continue
+        for folder in group:
+            signature = json.dumps(signatures[folder.path])
+            cached = known.get(folder.path)
+            if cached is not None and cached[0] == signature:
+                digest = cached[1]
+            else:
+                digest = _fingerprint_folder(folder)
+                if digest is None:
+                    continue
+                computed.append((folder.path, signature, digest))
+            by_digest.setdefault(digest, []).append(folder)
+    if index is not None and computed:
+        index.store_fingerprints(computed)
+
+    duplicates = []
+    for group in by_digest.values():
+        if len(group) < 2:
+            continue
+        group.sort(key=lambda folder: (not folder.has_output, folder.ctime))
+        duplicates += [(folder, group[0]) for folder in group[1:] if folder.path in wanted]
+    return duplicates
+
+def link_duplicates(duplicates, log=print):
+    """把重复目录的 mp4 硬链接到保留目录已合并的 mp4，不占用额外空间；保留的目录没有合并成功时跳过"""
+    for folder, original in duplicates:
+        # 合并为分P合集的目录没有自己的 mp4
+        if not original.has_output or os.path.basename(original.mp4_path) != original.mp4_name:
+            continue
+        try:
+            os.link(original.mp4_path, folder.mp4_path)
+        except OSError as e:
+            log(f"⚠️ 无法硬链接 {original.mp4_path} -> {folder.mp4_path}: {e}")
+            continue
+        folder.failed = False
+        folder.record_output()
+        log(f"🔗 {folder.name} 与 {original.name} 内容相同，已硬链接：{folder.mp4_path}")
+
+# 一个分P合集：合集编号、标题、按分P序号排列的 [(序号, 目录, 分P标题), ...]、合并后的文件
+Series = namedtuple('Series', 'key title parts output_file')
+
+# 用到的 videoInfo.json 字段，只有这些会记入索引
+VIDEO_INFO_FIELDS = ('groupId', 'bvid', 'aid', 'groupTitle', 'title', 'p', 'duration')
+
+def read_video_info(folder):
+    """客户端写在缓存目录中的 videoInfo.json 里用到的字段，没有或无法解析时返回空 dict。
+
+    结果保存在 folder.video_info 中随索引持久化，扫描时文件没有变化就不再读取。
+    """
+    if folder.video_info is not None:
+        return folder.video_info
+    info = {}
+    if folder.has('videoInfo.json'):
+        try:
+            with open(folder.file_path('videoInfo.json'), encoding='utf-8') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            info = {}
+    info = info if isinstance(info, dict) else {}
+    folder.video_info = {key: info[key] for key in VIDEO_INFO_FIELDS if key in info}
+    folder.dirty = True
+    return folder.video_info
+
+def _series_key(info):
+    for key in ('groupId', 'bvid', 'aid'):
+        if info.get(key):
+            return str(info[key])
+    return None
+
+def _safe_filename(name):
+    """去掉 Windows 文件名中不允许的字符"""
+    name = ''.join('_' if c in '\\/:*?"<>|' or ord(c) < 32 else c for c in name)
+    return name.strip(' .') or '_'
+
+def detect_series(snapshot, output_dir=None):
+    """按 videoInfo.json 中的合集编号（groupId / bvid / aid）和分P序号 p 找出分P视频，返回 Series 列表。
+
+    只有一个分P的不算合集；同一分P有多份缓存时取排在前面的。
+    合并后的文件以合集标题命名，写到 output_dir，未设置时写在第一个分P所在的缓存目录中。
+    """
+    groups = {}
+    for folder in snapshot:
+        info = read_video_info(folder)
+        key = _series_key(info)
+        if key is None:
+            continue
+        try:
+            number = int(info.get('p') or 0)
+        except (TypeError, ValueError):
+            number = 0
+        group = groups.setdefault(key, (str(info.get('groupTitle') or key), {}))
+        group[1].setdefault(number, (folder, str(info.get('title') or '')))
+
+    result = []
+    used = set()
+    for key, (title, parts) in groups.items():
+        if len(parts) < 2:
+            continue
+        parts = [(number, folder, part_title) for number, (folder, part_title) in sorted(parts.items())]
+        directory = output_dir or parts[0][1].path
+        output_file = os.path.join(directory, f"{_safe_filename(title)}.mp4")
+        if output_file in used:
+            output_file = os.path.join(directory, f"{_safe_filename(title)}_{_safe_filename(key)}.mp4")
+        used.add(output_file)
+        result.append(Series(key, title, parts, output_file))
+    return result
+
+def _series_up_to_date(series):
+    """合并好的文件比所有分P的原始缓存都新，说明之后没有新下载的分P"""
+    try:
+        built = os.stat(series.output_file).st_mtime
+        newest = max(
+            os.stat(folder.file_path(name)).st_mtime
+            for _, folder, _ in series.parts for name in folder.files
+            if name.endswith('.m4s') and name not in GENERATED_M4S
+        )
+    except (OSError, ValueError):
+        return False
+    return built >= newest
+
+def split_series(folders, output_dir=None, log=print):
+    """从本次要处理的目录中分出要合并为一个文件的分P合集，返回 (Series 列表, 其余目录)。
+
+    合集文件比各分P的原始缓存都新时直接把各分P记为已合并；有分P已经单独合并过的合集仍逐个合并；
+    其余合集由全部分P重新合并（监视模式下新分P下载完成后会整体重建）。
+    """
+    series_list = []
+    grouped = set()
+    for series in detect_series(folders, output_dir):
+        members = [folder for _, folder, _ in series.parts]
+        if any(folder.has_output and folder.mp4_path != series.output_file for folder in members):
+            log(f"ℹ️ 合集《{series.title}》已有分P单独合并过，仍逐个合并")
+            continue
+        grouped.update(folder.path for folder in members)
+        if _series_up_to_date(series):
+            for folder in members:
+                if folder.output_path != series.output_file:
+                    folder.output_path = series.output_file
+                    folder.dirty = True
+            continue
+        series_list.append(series)
+    return series_list, [folder for folder in folders if folder.path not in grouped]
+
+def with_series_parts(ready, snapshot, tracker):
+    """监视模式下把同一合集中已经下载完成的其他分P加进来，合集总是由全部分P一起合并。
+
+    各分P往往在不同轮次下载完成，合集中还有分P在下载时先不合并已完成的分P，
+    用 tracker.release 放回去，等其他分P都稳定后再一起交出。
+    """
+    keys = {folder.path: _series_key(read_video_info(folder)) for folder in snapshot}
+    wanted = {keys.get(folder.path) for folder in ready} - {None}
+    if not wanted:
+        return ready
+    downloading = {keys[folder.path] for folder in snapshot if keys[folder.path] in wanted and tracker.pending(folder)}
+    result = []
+    for folder in ready:
+        if keys.get(folder.path) in downloading:
+            tracker.release(folder)
+        else:
+            result.append(folder)
+    paths = {folder.path for folder in result}
+    wanted -= downloading
+    return result + [
+        folder for folder in snapshot
+        if folder.path not in paths and keys[folder.path] in wanted and tracker.settled(folder)
+    ]
+
+def _concat_line(path):
+    """ffconcat 列表中的一行，路径用单引号括起"""
+    return "file '" + path.replace("'", "'\\''") + "'\n"
+
+def _metadata_value(text):
+    """转义 ffmetadata 中有特殊含义的字符"""
+    for c in '\\=;#\n':
+        text = text.replace(c, '\\' + c)
+    return text
+
+def _info_duration(folder):
+    """videoInfo.json 中记录的时长（秒），没有或不合理时返回 0.0"""
+    try:
+        duration = float(read_video_info(folder).get('duration') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+    return duration if 0 < duration < float('inf') else 0.0
+
+def _plan_series(series, log=print):
+    """生成合并一个合集的 MergeTask，inputs 为 (视频列表, 音频列表, 元数据) 的内容；有分P无法识别时返回 None
+
+    章节按各分P的时长排列，有分P的时长无法从流和 videoInfo.json 得到时不写章节，只保留标题。
+    """
+    lists = ([], [])
+    chapters = []
+    size = 0
+    position = 0.0
+    for number, folder, part_title in series.parts:
+        names = folder.source_m4s()
+        header_sizes = [folder.header_size(name) for name in names]
+        if len(names) < 2 or None in header_sizes:
+            log(f"⚠️ 合集《{series.title}》的 P{number} 缺少可识别的缓存文件，跳过该合集：{folder.path}")
+            return None
+        # subfile 协议从填充头之后开始读，原始缓存不需要先复制、去头
+        for entries, name, header_size in zip(lists, names, header_sizes):
+            entries.append(_concat_line(f"subfile,,start,{header_size},end,0,,:{folder.file_path(name)}"))
+        task = _plan_task(folder, names, header_sizes, None, None)
+        size += task.size
+        duration = task.duration or _info_duration(folder)
+        if not duration:
+            if chapters is not None:
+                log(f"⚠️ 合集《{series.title}》的 P{number} 无法获取时长，合并后的文件不写章节")
+            chapters = None
+            continue
+        if chapters is not None:
+            title = f"P{number} {part_title}".strip()
+            chapters.append(
+                f"[CHAPTER]\nTIMEBASE=1/1000\nSTART={round(position * 1000)}\n"
+                f"END={round((position + duration) * 1000)}\ntitle={_metadata_value(title)}\n"
+            )
+        position += duration
+    metadata = f";FFMETADATA1\ntitle={_metadata_value(series.title)}\n" + ''.join(chapters or [])
+    inputs = (''.join(lists[0]), ''.join(lists[1]), metadata)
+    return MergeTask(series.parts[0][1], inputs, series.output_file, None, size, position)
+
+def _merge_series(ffmpeg_path, series, task, log=print, cancel_event=None, progress=None, report=None):
+    """用 ffmpeg 的 concat 输入一次流复制合并整个合集并写入章节，返回是否成功"""
+    _check_cancel(cancel_event)
+    part_path = partial_path(series.output_file)
+    log(f"Merging: 合集《{series.title}》，{len(series.parts)} 个分P")
+    on_progress = None
+    if progress is not None:
+        on_progress = lambda size, seconds: progress.update(series.output_file, size, min(seconds, task.duration))
+
+    ok = False
+    with _timed(report, 'merge', series.output_file) as timing, tempfile.TemporaryDirectory() as work_dir:
+        timing.update(bytes_read=task.size, engine='ffmpeg', parts=len(series.parts))
+        command = [ffmpeg_path]
+        for name, content in zip(('video.ffconcat', 'audio.ffconcat', 'chapters.txt'), task.inputs):
+            list_path = os.path.join(work_dir, name)
+            with open(list_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            if name.endswith('.ffconcat'):
+                command += ["-f", "concat", "-safe", "0", "-protocol_whitelist", "file,subfile", "-i", list_path]
+            else:
+                command += ["-f", "ffmetadata", "-i", list_path]
+        command += ["-map", "0", "-map", "1", "-map_metadata", "2"]
+        if '[CHAPTER]' in task.inputs[2]:
+            command += ["-map_chapters", "2"]
+        command += ["-c", "copy", "-f", "mp4", part_path]
+        try:
+            result = run_ffmpeg(command, cancel_event, on_progress)
+            timing['exit_code'] = result.returncode
+            if result.returncode == 0:
+                _commit_partial(part_path, series.output_file)
+                for _, folder, _ in series.parts:
+                    folder.failed = False
+                    folder.output_path = series.output_file
+                    folder.dirty = True
+                log(f"✅ 成功合并合集：{series.output_file}（{len(series.parts)} 个分P）")
+                ok = True
+            else:
+                log(f"❌ 合并合集失败：《{series.title}》\n{result.stderr}")
+                _remove_partial(part_path)
+                for _, folder, _ in series.parts:
+                    folder.failed = True
+                    folder.dirty = True
+        except BaseException:
+            _remove_partial(part_path)
+            raise
+        finally:
+            timing['ok'] = ok
+            if ok:
+                timing['bytes_written'] = os.path.getsize(series.output_file)
+            if progress is not None:
+                progress.complete(series.output_file, [(task, ok)])
+    return ok
+
+def merge_series(ffmpeg_path, series_list, progress_callback=None, log=print, cancel_event=None,
+                 transfer_callback=None, report=None):
+    """依次合并分P合集，每个合集一个 ffmpeg 进程，直接读取原始缓存，不写出各分P的 mp4；
+    返回合并失败的目录列表。进度回调与 merge_m4s_to_mp4 相同，按合集计数。"""
+    failed = []
+    planned = []
+    for series in series_list:
+        task = _plan_series(series, log)
+        if task is None:
+            failed += [folder.path for _, folder, _ in series.parts]
+        else:
+            planned.append((series, task))
+
+    progress = None
+    if transfer_callback is not None and planned:
+        progress = MergeProgress(
+            sum(task.size for _, task in planned), sum(task.duration for _, task in planned), transfer_callback
+        )
+    for done, (series, task) in enumerate(planned, 1):
+        if not _merge_series(ffmpeg_path, series, task, log, cancel_event, progress, report):
+            failed += [folder.path for _, folder, _ in series.parts]
+        if progress_callback:
+            progress_callback(done, len(planned), f"✨ 已处理合集: {series.title}")
+    return failed
+
+def recover_interrupted(snapshot, journal=None, log=print, output_dir=None):
+    """删除上次运行被中断时留下的 .part 临时文件。
+
+    正式文件都是写完后才改名得到的，可以直接信任；journal 中还停在 started 的阶段
+    会在本次运行中从该阶段重新开始，已完成的阶段不会重做。
+    设置了 output_dir 时 mp4 和合集文件写在缓存目录之外，其中残留的 *.mp4.part 也一并删除。
+    """
+    interrupted = journal.interrupted() if journal is not None else {}
+    stage_names = {'copy': '复制', 'strip': '去头', 'merge': '合并'}
+    for folder in snapshot:
+        leftovers = [name for name in folder.files if name.endswith(PARTIAL_SUFFIX)]
+        for name in leftovers:
+            _remove_partial(folder.file_path(name))
+            folder.forget(name)
+        stage = interrupted.get(folder.path)
+        if stage is not None:
+            log(f"♻️ {folder.name} 上次在{stage_names.get(stage, stage)}阶段中断，已清理临时文件，本次从该阶段继续")
+        elif leftovers:
+            log(f"🧹 已清理 {folder.name} 中未完成的临时文件")
+
+    if not output_dir:
+        return
+    try:
+        entries = [entry for entry in os.scandir(output_dir)
+                   if entry.name.endswith('.mp4' + PARTIAL_SUFFIX) and entry.is_file()]
+    except OSError:
+        return
+    for entry in entries:
+        _remove_partial(entry.path)
+        log(f"🧹 已清理未完成的输出 {entry.name}")
+
+def _format_size(size):
+    if size >= 1024 ** 3:
+        return f"{size / 1024 ** 3:.2f} GB"
+    return f"{size / 1024 ** 2:.1f} MB"
+
+def verify_merged(folder):
+    """检查合并出的 mp4 结构完整、时长与原始缓存一致，返回 (是否通过, 说明)"""
+    try:
+        duration, tracks = check_mp4(folder.mp4_path)
+    except (OSError, ValueError) as e:
+        return False, str(e)
+
+    expected = [folder.stream_info(name) for name in folder.source_m4s()]
+    expected = max([info.duration for info in expected if info and info.duration] or [0.0])
+    if tracks < 2:
+        return False, f"只有 {tracks} 条轨道"
+    if expected and duration is not None and abs(duration - expected) > max(1.0, expected * DURATION_TOLERANCE):
+        return False, f"时长 {duration:.1f} 秒与缓存的 {expected:.1f} 秒不一致"
+    return True, ""
+
+def cleanup_intermediates(snapshot, log=print, cancel_event=None, report=None):
+    """删除已合并目录中的 1/2.m4s 和 _delete8 中间文件，只处理 mp4 校验通过的目录；返回释放的字节数"""
+    freed = cleaned = 0
+    for folder in snapshot:
+        _check_cancel(cancel_event)
+        names = [name for name in GENERATED_M4S if folder.has(name)]
+        if not names or folder.state != 'merged':
+            continue
+        with _timed(report, 'cleanup', folder.path) as timing:
+            ok, detail = verify_merged(folder)
+            timing['ok'] = ok
+            if not ok:
+                log(f"⚠️ {folder.mp4_name} 校验未通过，保留中间文件：{detail}")
+                continue
+            size = 0
+            for name in names:
+                size += folder.files[name][0]
+                try:
+                    os.remove(folder.file_path(name))
+                except FileNotFoundError:
+                    pass
+                folder.forget(name)
+            timing['bytes_freed'] = size
+        freed += size
+        cleaned += 1
+        log(f"🧹 {folder.name} 已校验，删除 {len(names)} 个中间文件（{_format_size(size)}）")
+    if cleaned > 1:
+        log(f"🧹 共清理 {cleaned} 个目录，释放 {_format_size(freed)}")
+    return freed
+
+# folders：本次处理的目录；skipped：空间不足被跳过的目录；pipelined：是否逐个目录走完整个流程
+DiskPlan = namedtuple('DiskPlan', 'folders skipped pipelined')
+
+def _stage_bytes(folder, direct):
+    """预计写出的 (中间文件字节数, mp4 字节数)，已完成的阶段不计入"""
+    if folder.state == 'merged':
+        return 0, 0
+    size = sum(folder.files[name][0] for name in folder.source_m4s())
+    if direct:
+        return 0, size
+    intermediate = 0
+    if not (folder.has('1.m4s') and folder.has('2.m4s')):
+        intermediate += size
+    if not (folder.has('1_delete8.m4s') and folder.has('2_delete8.m4s')):
+        intermediate += size
+    return intermediate, size
+
+def plan_disk_space(snapshot, direct=False, cleanup=False, log=print, reserve=DISK_RESERVE_BYTES, output_dir=None):
+    """按各阶段要写出的字节数和剩余空间安排本次的处理方式，保证不会在半途写满磁盘。
+
+    空间足够时照常分阶段处理；开启清理但放不下全部中间文件时，改为逐个目录完成
+    复制、去头、合并和清理，同一时间只占用一个目录的中间文件；
+    连最终的 mp4 都放不下时，按新视频优先挑选放得下的目录，其余留到下次。
+    中间文件写在各自的缓存目录，mp4 写在 output_dir（未设置时同样写在缓存目录），
+    按各自所在磁盘的剩余空间分别计算，同一块磁盘上的写入合并计算。
+    """
+    # 磁盘（st_dev） -> (可用字节数, 用于提示的路径)
+    devices = {}
+    dev_of = {}
+
+    def device(path):
+        if path not in dev_of:
+            dev_of[path] = os.stat(path).st_dev
+            if dev_of[path] not in devices:
+                devices[dev_of[path]] = (shutil.disk_usage(path).free - reserve, path)
+        return dev_of[path]
+
+    def fits(intermediates, outputs):
+        """intermediates / outputs：磁盘 -> 字节数"""
+        need = Counter(intermediates)
+        need.update(outputs)
+        return all(size <= devices[dev][0] for dev, size in need.items())
+
+    output_dev = device(output_dir) if output_dir else None
+    # (目录, 中间文件所在磁盘, 中间文件字节数, mp4 所在磁盘, mp4 字节数)
+    sizes = []
+    for folder in snapshot:
+        cache_dev = device(os.path.dirname(folder.path))
+        intermediate, output = _stage_bytes(folder, direct)
+        sizes.append((folder, cache_dev, intermediate, cache_dev if output_dev is None else output_dev, output))
+
+    intermediates, outputs, largest = Counter(), Counter(), Counter()
+    for _, cache_dev, intermediate, out_dev, output in sizes:
+        intermediates[cache_dev] += intermediate
+        outputs[out_dev] += output
+        largest[cache_dev] = max(largest[cache_dev], intermediate)
+    if fits(intermediates, outputs):
+        return DiskPlan(list(snapshot), [], False)
+
+    if len(devices) == 1:
+        available = f"可用空间只有 {_format_size(max(0, next(iter(devices.values()))[0]))}"
+    else:
+        available = '，'.join(f"{path} 所在磁盘可用 {_format_size(max(0, free))}" for free, path in devices.values())
+    log(f"💽 预计写入中间文件 {_format_size(sum(intermediates.values()))}、mp4 {_format_size(sum(outputs.values()))}，{available}")
+    pipelined = cleanup and not direct
+    if pipelined and fits(largest, outputs):
+        log("💽 改为逐个目录完成复制、合并和清理，同一时间只保留一个目录的中间文件")
+        return DiskPlan(list(snapshot), [], True)
+
+    folders, skipped = [], []
+    used_intermediate, used_output = Counter(), Counter()
+    for folder, cache_dev, intermediate, out_dev, output in sizes:
+        next_intermediate, next_output = Counter(used_intermediate), Counter(used_output)
+        # 逐个处理时中间文件用完即删，只需留出最大的那一份；保留中间文件时全部计入
+        if pipelined:
+            next_intermediate[cache_dev] = max(next_intermediate[cache_dev], intermediate)
+        else:
+            next_intermediate[cache_dev] += intermediate
+        next_output[out_dev] += output
+        if fits(next_intermediate, next_output):
+            folders.append(folder)
+            used_intermediate, used_output = next_intermediate, next_output
+        else:
+            skipped.append(folder)
+    log(f"⚠️ 磁盘空间不足，本次跳过 {len(skipped)} 个目录，释放空间后再次运行即可继续")
+    return DiskPlan(folders, skipped, pipelined)
+
+def _run_pipelined(video_dir, ffmpeg_path, folders, progress_callback, log, cancel_event, journal, report,
+                   copy_engine, merge_options):
+    """逐个目录依次复制、去头、合并和清理，返回合并失败的目录列表；同一时间只合并一个目录"""
+    failed = []
+    total = len(folders)
+    # 各目录共用一个 MergeProgress，字节和时长进度按全部目录计算，不会每个目录从 0 开始
+    progress = None
+    estimates = {}
+    transfer_callback = merge_options.get('transfer_callback')
+    if transfer_callback is not None:
+        for folder in folders:
+            names = folder.source_m4s()
+            if not folder.has_output and len(names) >= 2:
+                header_sizes = [folder.header_size(name) or 0 for name in names]
+                estimates[folder.path] = _plan_task(folder, names, header_sizes, None, None)
+        progress = MergeProgress(
+            sum(task.size for task in estimates.values()), sum(task.duration for task in estimates.values()),
+            transfer_callback
+        )
+    for position, folder in enumerate(folders):
+        _check_cancel(cancel_event)
+        copy_and_rename_m4s(video_dir, log, cancel_event, [folder], journal=journal, report=report, engine=copy_engine)
+        delete_first_9_bytes(video_dir, log, cancel_event, [folder], journal=journal, report=report)
+        # 单个目录的进度换算成整体进度
+        step = progress_callback and (
+            lambda done, _, message, position=position: progress_callback(position + done, total, message)
+        )
+        result = merge_m4s_to_mp4(
+            video_dir, ffmpeg_path, step, direct=False, jobs=1, log=log, cancel_event=cancel_event,
+            snapshot=[folder], journal=journal, report=report, progress=progress, **merge_options
+        )
+        failed += result
+        estimate = estimates.get(folder.path)
+        if estimate is not None and not result and not folder.has_output:
+            # 复制或去头失败、没有进入合并的目录从总量中去掉，进度最后仍到 100%
+            progress.complete(folder.path, [(estimate, False)])
+        cleanup_intermediates([folder], log, cancel_event, report)
+    return failed
+
+def run_pipeline(video_dir, ffmpeg_path, settings, progress_callback=None, status_callback=None,
+                 log=print, cancel_event=None, snapshot=None, index=None, transfer_callback=None, report=None,
+                 library=None):
+    """按配置依次执行复制、去头和合并，返回合并失败（以及因磁盘空间不足未处理）的目录列表。
+
+    整个流程只扫描一次目录，传入的 snapshot 会随各阶段写出的文件同步更新；
+    开始前按 plan_disk_space 检查剩余空间，cleanup 为 intermediates 时合并并校验后删除中间文件。
+    concat_series 开启时分P合集由 merge_series 合并为一个文件，见 split_series。
+    dedup 不为 off 时跳过与其他缓存内容相同的目录（见 find_duplicates），link 时在合并后硬链接保留目录的 mp4；
+    library 为完整的扫描结果，snapshot 只是其中一部分（监视模式）时传入，用来和已合并的目录比较。
+    传入 index 时，各阶段的进度记入 index 的 journal，上次中断的目录会从中断的阶段继续，
+    结束（包括取消和出错）后把有变化的目录写回索引。
+    report 为 RunReport 时记录各阶段每个目录的耗时、读写字节数和 ffmpeg 退出码。
+    """
+    if snapshot is None:
+        snapshot = scan_library(video_dir, index, settings['output_dir'], report)
+
+    try:
+        for folder in snapshot:
+            if folder.shadowed and not folder.has_output:
+                log(f"ℹ️ {folder.name} 在多个缓存目录中都有，使用 {folder.path}，跳过 {'、'.join(folder.shadowed)}")
+        recover_interrupted(snapshot, index, log, settings['output_dir'] or None)
+        if settings['output_dir']:
+            os.makedirs(settings['output_dir'], exist_ok=True)
+        direct = settings['merge_mode'] == 'direct'
+        cleanup = settings['cleanup'] == 'intermediates'
+        plan = plan_disk_space(snapshot, direct, cleanup, log, output_dir=settings['output_dir'] or None)
+        skipped = [folder.path for folder in plan.skipped]
+        merge_options = dict(
+            engine=settings['remux_engine'], batch_size=settings['batch_size'], transfer_callback=transfer_callback
+        )
+        folders = plan.folders
+        duplicates = []
+        if settings['dedup'] != 'off':
+            duplicates = find_duplicates(folders, library, index)
+            if duplicates:
+                action = "合并后硬链接已有的 mp4" if settings['dedup'] == 'link' else "跳过合并"
+                log(f"🔁 {len(duplicates)} 个目录与其他缓存内容相同，{action}")
+                repeated = {folder.path for folder, _ in duplicates}
+                folders = [folder for folder in folders if folder.path not in repeated]
+        # 分P合集直接从原始缓存合并为一个文件，不经过复制、去头和逐个合并
+        series = []
+        if settings['concat_series']:
+            series, folders = split_series(folders, settings['output_dir'] or None, log)
+
+        def finish(failed):
+            if series:
+                if status_callback:
+                    status_callback("🔄 正在合并分P合集...")
+                failed = failed + merge_series(
+                    ffmpeg_path, series, progress_callback, log, cancel_event, transfer_callback, report
+                )
+            if duplicates and settings['dedup'] == 'link':
+                link_duplicates(duplicates, log)
+            return failed + skipped
+
+        if plan.pipelined:
+            if status_callback:
+                status_callback("🔄 正在逐个处理视频...")
+            return finish(_run_pipelined(
+                video_dir, ffmpeg_path, folders, progress_callback, log, cancel_event, index, report,
+                settings['copy_engine'], merge_options
+            ))
+
+        if not direct:
+            if status_callback:
+                status_callback("🔄 正在复制和重命名m4s文件...")
+            copy_and_rename_m4s(
+                video_dir, log, cancel_event, folders, journal=index, report=report, engine=settings['copy_engine']
+            )
+
+            if status_callback:
+                status_callback("🔄 正在处理m4s文件...")
+            delete_first_9_bytes(video_dir, log, cancel_event, folders, journal=index, report=report)
+
+        if status_callback:
+            status_callback("🔄 正在合并视频...")
+        failed = merge_m4s_to_mp4(
+            video_dir, ffmpeg_path, progress_callback,
+            direct=direct, jobs=settings['jobs'], log=log, cancel_event=cancel_event, snapshot=folders,
+            journal=index, report=report, **merge_options
+        )
+        if cleanup:
+            if status_callback:
+                status_callback("🧹 正在清理中间文件...")
+            cleanup_intermediates(folders, log, cancel_event, report)
+        return finish(failed)
+    finally:
+        if index is not None:
+            index.store([f for f in snapshot if f.dirty])
+
+def get_thumbnail_dir(config_path='config.ini'):
+    """集中存放缩略图的缓存目录，与 config.ini 放在同一目录"""
+    return os.path.join(os.path.dirname(os.path.abspath(config_path)), 'thumbnails')
+
+def thumbnail_cache_path(cache_dir, mp4_path):
+    """缩略图文件名由视频路径和修改时间决定，视频重新合并后旧缩略图自动失效"""
+    mtime = os.stat(mp4_path).st_mtime
+    key = hashlib.sha1(f"{os.path.abspath(mp4_path)}|{mtime}".encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f"{key}.jpg")
+
+def extract_thumbnail(ffmpeg_path, mp4_path, cache_dir, report=None):
+    """截取视频画面作为缩略图存入缓存目录，返回缩略图路径，失败时返回 None；
+    report 为 RunReport 时记录实际调用 ffmpeg 的耗时和退出码"""
+    thumb_path = thumbnail_cache_path(cache_dir, mp4_path)
+    if os.path.isfile(thumb_path):
+        return thumb_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    part_path = thumb_path[:-len('.jpg')] + '.part.jpg'
+    with _timed(report, 'thumbnail', mp4_path) as timing:
+        # -ss 放在 -i 之前按关键帧快速定位，不用从头解码；不足 5 秒的视频退回第一帧
+        for position in ('5', '0'):
+            cmd = [
+                ffmpeg_path,
+                '-y',
+                '-ss', position,
+                '-i', mp4_path,
+                '-frames:v', '1',
+                '-q:v', '2',
+                part_path
+            ]
+            result = run_ffmpeg(cmd)
+            timing['exit_code'] = result.returncode
+            if result.returncode == 0 and os.path.isfile(part_path) and os.path.getsize(part_path) > 0:
+                timing['bytes_written'] = os.path.getsize(part_path)
+                os.replace(part_path, thumb_path)
+                return thumb_path
+        timing['ok'] = False
+    _remove_partial(part_path)
+    return None
+
+class StabilityTracker:
+    """监视模式下判断缓存是否下载完成。
+
+    每轮检查记录未合并目录中原始 .m4s 的文件名和大小，连续 settle_checks 轮都没有变化
+    才认为客户端已经写完，交给合并流程；仍在增长的文件不会被处理。
+    """
+
+    def __init__(self, settle_checks=2, incomplete_checks=60):
+        self.settle_checks = settle_checks
+        # 只下载出一个流的目录可能正在等客户端开始下一个流，等这么多轮没有变化才认为它不会再更新
+        self.incomplete_checks = incomplete_checks
+        # 路径 -> (文件签名, 连续未变化的轮数)
+        self._seen = {}
+        # 路径 -> 入队时的文件签名，签名不变就不会重复入队
+        self._queued = {}
+
+    @staticmethod
+    def signature(folder):
+        return tuple(sorted(
+            (name, size) for name, (size, _) in folder.files.items()
+            if name.endswith('.m4s') and name not in GENERATED_M4S
+        ))
+
+    def settled(self, folder):
+        """已合并，或之前已确认下载完成、之后文件没有再变化"""
+        return folder.state == 'merged' or self._queued.get(folder.path) == self.signature(folder)
+
+    def _checks_needed(self, folder):
+        return self.settle_checks if len(folder.source_m4s()) >= 2 else self.incomplete_checks
+
+    def pending(self, folder):
+        """仍在下载：未确认完成，文件最近还有变化；只有一个流的目录按 incomplete_checks 判断"""
+        if self.settled(folder):
+            return False
+        sig, count = self._seen.get(folder.path, (None, 0))
+        return sig != self.signature(folder) or count < self._checks_needed(folder)
+
+    def release(self, folder):
+        """撤销 check 对 folder 的确认，文件不变时下一轮 check 会再次把它列为可以合并"""
+        self._queued.pop(folder.path, None)
+
+    def check(self, snapshot):
+        """返回 (本轮确认完成、可以合并的目录列表, 仍在等待稳定的目录数)"""
+        ready = []
+        waiting = 0
+        alive = set()
+        for folder in snapshot:
+            if folder.state == 'merged':
+                continue
+            alive.add(folder.path)
+            sig = self.signature(folder)
+            if self._queued.get(folder.path) == sig:
+                continue
+
+            last_sig, count = self._seen.get(folder.path, (None, 0))
+            count = count + 1 if sig == last_sig else 0
+            self._seen[folder.path] = (sig, count)
+            if len(folder.source_m4s()) < 2:
+                # 音视频还没有都出现，不能合并；仍可能继续下载时算作等待，with_series_parts 据此判断合集是否下载完
+                if count < self.incomplete_checks:
+                    waiting += 1
+                continue
+            if count >= self.settle_checks:
+                ready.append(folder)
+                self._queued[folder.path] = sig
+            else:
+                waiting += 1
+
+        for table in (self._seen, self._queued):
+            for path in [p for p in table if p not in alive]:
+                del table[path]
+        return ready, waiting
+
+def watch_library(video_dir, ffmpeg_path, settings, index=None, log=print, cancel_event=None, on_report=None):
+    """无界面监视模式：轮询缓存目录，只把下载完成的新目录送进合并流程，直到 cancel_event 被设置。
+
+    on_report(RunReport) 在每轮合并结束后调用，用于保存运行报告。
+    """
+    tracker = StabilityTracker()
+    interval = max(1, settings['watch_interval'])
+    log(f"👀 正在监视 {'、'.join(split_video_dirs(video_dir))}，每 {interval} 秒检查一次")
+    while cancel_event is None or not cancel_event.is_set():
+        snapshot = scan_library(video_dir, index, settings['output_dir'])
+        ready, _ = tracker.check(snapshot)
+        if ready and settings['concat_series']:
+            ready = with_series_parts(ready, snapshot, tracker)
+        if ready:
+            log(f"📥 发现 {len(ready)} 个下载完成的新缓存: {', '.join(f.name for f in ready)}")
+            report = RunReport() if on_report is not None else None
+            try:
+                failed = run_pipeline(
+                    video_dir, ffmpeg_path, settings,
+                    log=log, cancel_event=cancel_event, snapshot=ready, index=index, report=report,
+                    library=snapshot
+                )
+            finally:
+                if report is not None:
+                    on_report(report)
+            if failed:
+                log(f"❌ {len(failed)} 个目录合并失败")
+        if cancel_event is not None:
+            cancel_event.wait(interval)
+        else:
+            time.sleep(interval)
@@ -0,0 +1,134 @@
+"""运行报告：记录每个目录、每个阶段的耗时、读写字节数和 ffmpeg 退出码，输出为 JSON Lines、汇总表和 Prometheus 文本文件"""
+import contextlib
+import json
+import os
+import threading
+import time
+import unicodedata
+
+# 汇总表和 Prometheus 指标中各阶段的排列顺序
+STAGES = ('scan', 'copy', 'strip', 'merge', 'cleanup', 'thumbnail', 'preview')
+
+
+def pad_display(text, width, left=False):
+    """按显示宽度补齐空格，中文字符占两列"""
+    text = str(text)
+    shown = sum(2 if unicodedata.east_asian_width(c) in 'WF' else 1 for c in text)
+    padding = ' ' * max(0, width - shown)
+    return text + padding if left else padding + text
+
+
+class RunReport:
+    """一次运行（合并流程或界面会话）的计时记录，多个合并线程可同时写入"""
+
+    def __init__(self):
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, stage, folder=None):
+        """计时一个阶段，返回的 dict 可填写 bytes_read / bytes_written / exit_code 等字段；
+        阶段内抛出异常时记为失败"""
+        entry = {'stage': stage, 'folder': folder, 'bytes_read': 0, 'bytes_written': 0, 'exit_code': None, 'ok': True}
+        start = time.perf_counter()
+        try:
+            yield entry
+        except BaseException:
+            entry['ok'] = False
+            raise
+        finally:
+            entry['seconds'] = time.perf_counter() - start
+            self.add(entry)
+
+    def add(self, entry):
+        entry = dict(entry, run=self.run_id, time=round(time.time(), 3))
+        entry['seconds'] = round(entry.get('seconds', 0.0), 6)
+        with self._lock:
+            self.records.append(entry)
+
+    def summary(self):
+        """按阶段汇总：{阶段: {'count', 'seconds', 'bytes_read', 'bytes_written', 'failed', 'slowest'}}"""
+        with self._lock:
+            records = list(self.records)
+        result = {}
+        for entry in records:
+            row = result.setdefault(entry['stage'], {
+                'count': 0, 'seconds': 0.0, 'bytes_read': 0, 'bytes_written': 0, 'failed': 0, 'slowest': None
+            })
+            row['count'] += 1
+            row['seconds'] += entry['seconds']
+            row['bytes_read'] += entry['bytes_read']
+            row['bytes_written'] += entry['bytes_written']
+            row['failed'] += 0 if entry['ok'] else 1
+            if entry['folder'] and (row['slowest'] is None or entry['seconds'] > row['slowest'][1]):
+                row['slowest'] = (entry['folder'], entry['seconds'])
+        for row in result.values():
+            row['seconds'] = round(row['seconds'], 6)
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        return dict(sorted(result.items(), key=lambda item: order.get(item[0], len(order))))
+
+    def format_summary(self):
+        """汇总表的各行文本"""
+        widths = (10, 6, 10, 10, 10, 8, 6)
+        header = ('阶段', '次数', '耗时(秒)', '读取(MB)', '写入(MB)', 'MB/s', '失败')
+        lines = [''.join(pad_display(cell, w, i == 0) for i, (cell, w) in enumerate(zip(header, widths))) + '  最慢的目录']
+        for stage, row in self.summary().items():
+            moved = max(row['bytes_read'], row['bytes_written']) / 1024 / 1024
+            cells = (
+                stage, row['count'], f"{row['seconds']:.2f}",
+                f"{row['bytes_read'] / 1024 / 1024:.1f}", f"{row['bytes_written'] / 1024 / 1024:.1f}",
+                f"{moved / row['seconds']:.1f}" if row['seconds'] > 0 and moved else '-', row['failed']
+            )
+            slowest = f"{os.path.basename(row['slowest'][0])}（{row['slowest'][1]:.2f} 秒）" if row['slowest'] else ''
+            lines.append(''.join(pad_display(cell, w, i == 0) for i, (cell, w) in enumerate(zip(cells, widths))) + '  ' + slowest)
+        lines.append(f"总耗时 {time.time() - self.started:.2f} 秒")
+        return lines
+
+    def write_jsonl(self, path):
+        """把每条记录追加为一行 JSON，最后一行为本次运行的汇总"""
+        with self._lock:
+            records = list(self.records)
+        total = {
+            'run': self.run_id, 'stage': 'total', 'time': round(time.time(), 3),
+            'seconds': round(time.time() - self.started, 6),
+            'stages': {stage: dict(row, slowest=row['slowest'] and row['slowest'][0]) for stage, row in self.summary().items()}
+        }
+        with open(path, 'a', encoding='utf-8') as f:
+            for entry in records + [total]:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def write_prometheus(self, path):
+        """写出 node_exporter textfile collector 格式的指标，先写临时文件再改名，采集时不会读到半个文件"""
+        metrics = [
+            ('bili_stage_seconds', 'Wall time spent in each stage during the last run', 'seconds'),
+            ('bili_stage_items', 'Folders (or scans) processed by each stage during the last run', 'count'),
+            ('bili_stage_read_bytes', 'Bytes read by each stage during the last run', 'bytes_read'),
+            ('bili_stage_written_bytes', 'Bytes written by each stage during the last run', 'bytes_written'),
+            ('bili_stage_failures', 'Failed items in each stage during the last run', 'failed'),
+        ]
+        summary = self.summary()
+        lines = []
+        for name, help_text, key in metrics:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            lines += [f'{name}{{stage="{stage}"}} {row[key]}' for stage, row in summary.items()]
+        lines += [
+            "# HELP bili_run_duration_seconds Wall time of the last run",
+            "# TYPE bili_run_duration_seconds gauge",
+            f"bili_run_duration_seconds {time.time() - self.started:.3f}",
+            "# HELP bili_run_timestamp_seconds Unix time when the last run finished",
+            "# TYPE bili_run_timestamp_seconds gauge",
+            f"bili_run_timestamp_seconds {time.time():.0f}",
+        ]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+    def save(self, jsonl_path=None, metrics_path=None):
+        """按配置写出 JSON Lines 报告和 Prometheus 指标，路径为空时跳过"""
+        if jsonl_path:
+            self.write_jsonl(jsonl_path)
+        if metrics_path:
+            self.write_prometheus(metrics_path)
@@ -0,0 +1,293 @@
+"""MP4 / fMP4 的 box 级轻量解析，只内存映射文件开头的少量字节，不启动任何外部进程"""
+import mmap
+import os
+import struct
+import threading
+from collections import namedtuple
+
+# 探测时映射的文件开头字节数，哔哩哔哩缓存的 ftyp + moov + sidx 通常只有几 KB
+PROBE_SIZE = 16 * 1024
+# 长视频的 sidx 超出 PROBE_SIZE 时最多映射到多少字节（每个分段 12 字节，约 8 万个分段）
+SIDX_PROBE_LIMIT = 1024 * 1024
+
+# 在文件开头多少字节内寻找第一个 MP4 box，超出则认为不是带填充头的 MP4
+HEADER_SCAN_LIMIT = 1024
+# 最多记住多少种不同的填充头，防止每个文件填充都不同时缓存无限增长
+HEADER_CACHE_SIZE = 64
+
+# kind: video / audio / 其他 handler 类型；codec: stsd 中的编码 fourcc；duration: 秒，未知时为 None；
+# header_size: MP4 数据之前的填充字节数
+StreamInfo = namedtuple('StreamInfo', 'kind codec duration header_size')
+
+_CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'mvex', b'edts'}
+_HANDLER_KINDS = {'vide': 'video', 'soun': 'audio'}
+
+
+def iter_boxes(buf, start, end):
+    """依次返回 [start, end) 范围内的 (类型, 内容起点, box 终点)，超出范围的 box 会被截断到 end"""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', buf, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            size = struct.unpack_from('>Q', buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        yield box_type, pos + header, min(pos + size, end)
+        pos += size
+
+
+def is_first_box(buf, pos, end):
+    """pos 处是否是一个合理的 ftyp/styp box：大小合适、品牌是可打印字符，后面紧跟另一个 box"""
+    if pos + 16 > end:
+        return False
+    size, box_type = struct.unpack_from('>I4s', buf, pos)
+    if box_type not in (b'ftyp', b'styp') or not 16 <= size <= 4096:
+        return False
+    if not bytes(buf[pos + 8:pos + 12]).isascii():
+        return False
+    next_pos = pos + size
+    if next_pos + 8 > end:
+        return True
+    return bytes(buf[next_pos + 4:next_pos + 8]).isalnum()
+
+
+def find_header_size(buf, end, limit=HEADER_SCAN_LIMIT):
+    """在前 limit 字节内查找第一个 ftyp/styp box，返回它的偏移，即填充头长度；找不到时返回 None"""
+    window = bytes(buf[:min(end, limit + 8)])
+    candidates = []
+    for box_type in (b'ftyp', b'styp'):
+        pos = window.find(box_type, 4)
+        while pos != -1:
+            if is_first_box(buf, pos - 4, end):
+                candidates.append(pos - 4)
+                break
+            pos = window.find(box_type, pos + 1)
+    return min(candidates) if candidates else None
+
+
+class HeaderCache:
+    """记住已经见过的填充头内容及其长度。
+
+    同一客户端版本写出的缓存填充内容相同，第一次扫描后按前缀比对即可，不必每个文件都重新扫描。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 填充头字节 -> 长度
+        self._known = {}
+
+    def lookup(self, buf, end):
+        """返回 buf 的填充头长度，未见过的格式会扫描一次并记住；无法识别时返回 None"""
+        with self._lock:
+            known = list(self._known.items())
+        for signature, size in known:
+            if bytes(buf[:size]) == signature and is_first_box(buf, size, end):
+                return size
+
+        size = find_header_size(buf, end)
+        if size is not None:
+            with self._lock:
+                if len(self._known) < HEADER_CACHE_SIZE:
+                    self._known[bytes(buf[:size])] = size
+        return size
+
+    def items(self):
+        with self._lock:
+            return list(self._known.items())
+
+    def update(self, items):
+        with self._lock:
+            for signature, size in items:
+                if len(self._known) < HEADER_CACHE_SIZE:
+                    self._known[bytes(signature)] = size
+
+
+# 进程内共用的填充头缓存，LibraryIndex 会在启动时载入、保存时写回
+header_cache = HeaderCache()
+
+
+def _full_box(buf, pos):
+    """读取 FullBox 的 version，返回 (version, 跳过 version/flags 后的位置)"""
+    return buf[pos], pos + 4
+
+
+def _parse_mdhd(buf, pos):
+    version, pos = _full_box(buf, pos)
+    if version == 1:
+        timescale, duration = struct.unpack_from('>IQ', buf, pos + 16)
+    else:
+        timescale, duration = struct.unpack_from('>II', buf, pos + 8)
+    return timescale, duration
+
+
+def _parse_sidx_duration(buf, pos, end):
+    """sidx 中各分段时长之和（秒），用于 moov 没有写时长的分片流"""
+    version, pos = _full_box(buf, pos)
+    timescale = struct.unpack_from('>I', buf, pos + 4)[0]
+    pos += 8 + (8 if version == 0 else 16)
+    count = struct.unpack_from('>H', buf, pos + 2)[0]
+    pos += 4
+    if not timescale or pos + count * 12 > end:
+        return None
+    total = sum(struct.unpack_from('>I', buf, pos + i * 12 + 4)[0] for i in range(count))
+    return total / timescale
+
+
+def _parse_trak(buf, start, end, info):
+    for box_type, pos, box_end in iter_boxes(buf, start, end):
+        if box_type == b'mdhd':
+            info['timescale'], info['duration'] = _parse_mdhd(buf, pos)
+        elif box_type == b'hdlr':
+            info['handler'] = buf[pos + 8:pos + 12].decode('latin-1')
+        elif box_type == b'stsd':
+            # version/flags + entry_count 之后是第一个 sample entry，其类型就是编码 fourcc
+            info['codec'] = buf[pos + 12:pos + 16].decode('latin-1')
+        elif box_type in _CONTAINERS:
+            _parse_trak(buf, pos, box_end, info)
+
+
+def parse_init_segment(buf, start, end):
+    """解析从 start 开始的初始化段，返回第一条轨道的 StreamInfo；找不到 ftyp/moov 时返回 None"""
+    boxes = list(iter_boxes(buf, start, end))
+    if not boxes or boxes[0][0] not in (b'ftyp', b'styp'):
+        return None
+
+    track = None
+    movie_timescale = fragment_duration = sidx_duration = None
+    for box_type, pos, box_end in boxes:
+        if box_type == b'moov':
+            for child, child_pos, child_end in iter_boxes(buf, pos, box_end):
+                if child == b'mvhd':
+                    version, p = _full_box(buf, child_pos)
+                    movie_timescale = struct.unpack_from('>I', buf, p + (16 if version == 1 else 8))[0]
+                elif child == b'trak' and track is None:
+                    track = {}
+                    _parse_trak(buf, child_pos, child_end, track)
+                elif child == b'mvex':
+                    for ext, ext_pos, _ in iter_boxes(buf, child_pos, child_end):
+                        if ext == b'mehd':
+                            version, p = _full_box(buf, ext_pos)
+                            fragment_duration = struct.unpack_from('>Q' if version == 1 else '>I', buf, p)[0]
+        elif box_type == b'sidx' and sidx_duration is None:
+            sidx_duration = _parse_sidx_duration(buf, pos, box_end)
+
+    if not track or 'handler' not in track:
+        return None
+
+    duration = None
+    if track.get('timescale') and track.get('duration'):
+        duration = track['duration'] / track['timescale']
+    elif movie_timescale and fragment_duration:
+        duration = fragment_duration / movie_timescale
+    elif sidx_duration:
+        duration = sidx_duration
+
+    kind = _HANDLER_KINDS.get(track['handler'], track['handler'])
+    return StreamInfo(kind, track.get('codec'), duration, start)
+
+
+def _sidx_end(buf, start, end):
+    """初始化段中第一个 sidx box 的实际结束位置（可能超出 end），遇到 moof/mdat 或没有 sidx 时返回 None"""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', buf, pos)
+        if size == 1:
+            if pos + 16 > end:
+                return None
+            size = struct.unpack_from('>Q', buf, pos + 8)[0]
+        if size < 8 or box_type in (b'moof', b'mdat'):
+            return None
+        if box_type == b'sidx':
+            return pos + size
+        pos += size
+    return None
+
+
+def probe_stream(path, offset=None, probe_size=PROBE_SIZE, cache=header_cache):
+    """内存映射文件开头 probe_size 字节，跳过填充头后识别轨道类型、编码和时长。
+
+    offset 为 None 时自动检测填充头长度（结果记入 cache）。
+    时长只能从 sidx 得到而 sidx 超出映射范围时（分段很多的长视频），按 sidx 的实际大小重新映射一次。
+    文件不是可识别的 MP4 或 moov 不在映射范围内时返回 None。
+    """
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        length = min(file_size, probe_size)
+        if length < 16:
+            return None
+        with mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ) as buf:
+            if offset is None:
+                offset = cache.lookup(buf, length)
+                if offset is None:
+                    return None
+            try:
+                info = parse_init_segment(buf, offset, length)
+                if info is None or info.duration is not None or length == file_size:
+                    return info
+                needed = _sidx_end(buf, offset, length)
+            except (struct.error, IndexError):
+                return None
+        if needed is None or not length < needed <= min(file_size, SIDX_PROBE_LIMIT):
+            return info
+        with mmap.mmap(f.fileno(), needed, access=mmap.ACCESS_READ) as buf:
+            try:
+                return parse_init_segment(buf, offset, needed) or info
+            except (struct.error, IndexError):
+                return info
+
+
+def check_mp4(path):
+    """逐个检查 MP4 的顶层 box 是否完整，返回 (mvhd 中的时长秒数或 None, 轨道数)。
+
+    只读取 box 头和 moov，文件被截断、缺少 ftyp/moov/mdat 或没有轨道时抛出 ValueError。
+    """
+    file_size = os.path.getsize(path)
+    seen = set()
+    moov = None
+    with open(path, 'rb') as f:
+        pos = 0
+        while pos < file_size:
+            f.seek(pos)
+            header = f.read(16)
+            if len(header) < 8:
+                raise ValueError("文件末尾不完整")
+            size, box_type = struct.unpack_from('>I4s', header)
+            header_size = 8
+            if size == 1 and len(header) == 16:
+                size = struct.unpack_from('>Q', header, 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = file_size - pos
+            if size < header_size or pos + size > file_size:
+                raise ValueError(f"{box_type.decode('latin-1')} box 被截断")
+            if box_type == b'moov':
+                f.seek(pos + header_size)
+                moov = f.read(size - header_size)
+            seen.add(box_type)
+            pos += size
+
+    if b'ftyp' not in seen or b'mdat' not in seen or moov is None:
+        raise ValueError("缺少 ftyp、moov 或 mdat")
+
+    duration = None
+    tracks = 0
+    for box_type, pos, _ in iter_boxes(moov, 0, len(moov)):
+        if box_type == b'mvhd':
+            version = moov[pos]
+            if version == 1:
+                timescale, value = struct.unpack_from('>IQ', moov, pos + 20)
+            else:
+                timescale, value = struct.unpack_from('>II', moov, pos + 12)
+            if timescale and value:
+                duration = value / timescale
+        elif box_type == b'trak':
+            tracks += 1
+    if tracks == 0:
+        raise ValueError("moov 中没有轨道")
+    return duration, tracks
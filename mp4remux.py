@@ -0,0 +1,522 @@
+"""内置的纯 Python 合并：把各含一条轨道的分片 MP4（哔哩哔哩 DASH 缓存）合成一个普通 MP4。
+
+只解析 box 结构，按 trun 重建 moov 中的采样表，媒体数据按字节范围从源文件直接复制到输出，
+不解码、不经过 ffmpeg。遇到不支持的结构时抛出 RemuxUnsupported，由调用方改用 ffmpeg。
+"""
+import mmap
+import os
+import queue
+import struct
+import threading
+
+from mp4box import iter_boxes
+
+# 复制媒体数据时单次读写的块大小
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# 跨磁盘写入时最多有多少个已读出、等待写入的数据块
+PIPELINE_DEPTH = 4
+# 输出文件 mvhd/tkhd 使用的时间刻度（毫秒）
+MOVIE_TIMESCALE = 1000
+
+# tfhd / trun 的标志位
+TFHD_BASE_DATA_OFFSET = 0x000001
+TFHD_SAMPLE_DESCRIPTION_INDEX = 0x000002
+TFHD_DEFAULT_DURATION = 0x000008
+TFHD_DEFAULT_SIZE = 0x000010
+TFHD_DEFAULT_FLAGS = 0x000020
+TRUN_DATA_OFFSET = 0x000001
+TRUN_FIRST_SAMPLE_FLAGS = 0x000004
+TRUN_DURATION = 0x000100
+TRUN_SIZE = 0x000200
+TRUN_FLAGS = 0x000400
+TRUN_CTS = 0x000800
+# sample_flags 中的 sample_is_non_sync_sample
+SAMPLE_NON_SYNC = 0x00010000
+
+_MEDIA_HEADERS = (b'vmhd', b'smhd', b'nmhd', b'sthd', b'hmhd')
+
+
+class RemuxUnsupported(Exception):
+    """输入不是内置合并能处理的分片 MP4，需要改用 ffmpeg"""
+
+
+class _Track:
+    """一个输入文件中的轨道：moov 里需要原样保留的 box 和从各个 moof 收集的采样信息"""
+
+    def __init__(self, path, header_size):
+        self.path = path
+        self.header_size = header_size
+        self.track_id = None
+        self.movie_timescale = None
+        self.timescale = None
+        self.language = 0
+        self.tkhd_tail = None
+        self.elst = None
+        self.hdlr = None
+        self.media_header = None
+        self.dinf = None
+        self.stsd = None
+        self.handler = None
+        # trex 中的默认值：(采样描述索引, 时长, 大小, 标志)
+        self.defaults = (1, 0, 0, 0)
+        self.durations = []
+        # 已收集采样的总时长（媒体时间刻度），也是下一个片段应有的解码时间
+        self.duration = 0
+        self.sizes = []
+        self.sync = []
+        self.cts = []
+        # 每个 trun 对应输出中的一个 chunk：(源文件偏移, 字节数, 采样数, 解码时间)
+        self.chunks = []
+
+    @property
+    def movie_duration(self):
+        return self.duration * MOVIE_TIMESCALE // self.timescale
+
+
+def _u32(buf, pos):
+    return struct.unpack_from('>I', buf, pos)[0]
+
+
+def _version_flags(buf, pos):
+    value = _u32(buf, pos)
+    return value >> 24, value & 0xFFFFFF
+
+
+def _parse_moov(buf, start, end, track):
+    traks = 0
+    for box_type, pos, box_end in iter_boxes(buf, start, end):
+        if box_type == b'mvhd':
+            version, _ = _version_flags(buf, pos)
+            track.movie_timescale = _u32(buf, pos + (20 if version == 1 else 12))
+        elif box_type == b'trak':
+            traks += 1
+            _parse_trak(buf, pos, box_end, track)
+        elif box_type == b'mvex':
+            for child, child_pos, _ in iter_boxes(buf, pos, box_end):
+                if child == b'trex':
+                    track.defaults = struct.unpack_from('>4I', buf, child_pos + 8)
+    if traks != 1:
+        raise RemuxUnsupported(f"包含 {traks} 条轨道")
+    if track.defaults[0] != 1:
+        raise RemuxUnsupported("使用了多个采样描述")
+
+
+def _parse_trak(buf, start, end, track):
+    for box_type, pos, box_end in iter_boxes(buf, start, end):
+        if box_type == b'tkhd':
+            version, _ = _version_flags(buf, pos)
+            if version == 1:
+                track.track_id = _u32(buf, pos + 20)
+                track.tkhd_tail = bytes(buf[pos + 36:box_end])
+            else:
+                track.track_id = _u32(buf, pos + 12)
+                track.tkhd_tail = bytes(buf[pos + 24:box_end])
+        elif box_type == b'edts':
+            for child, child_pos, _ in iter_boxes(buf, pos, box_end):
+                if child == b'elst':
+                    track.elst = _parse_elst(buf, child_pos)
+        elif box_type in (b'mdia', b'minf', b'stbl'):
+            _parse_trak(buf, pos, box_end, track)
+        elif box_type == b'mdhd':
+            version, _ = _version_flags(buf, pos)
+            if version == 1:
+                track.timescale = _u32(buf, pos + 20)
+                track.language = struct.unpack_from('>H', buf, pos + 32)[0]
+            else:
+                track.timescale = _u32(buf, pos + 12)
+                track.language = struct.unpack_from('>H', buf, pos + 20)[0]
+        elif box_type == b'hdlr':
+            track.handler = bytes(buf[pos + 8:pos + 12])
+            track.hdlr = bytes(buf[pos - 8:box_end])
+        elif box_type in _MEDIA_HEADERS:
+            track.media_header = bytes(buf[pos - 8:box_end])
+        elif box_type == b'dinf':
+            track.dinf = bytes(buf[pos - 8:box_end])
+        elif box_type == b'stsd':
+            track.stsd = bytes(buf[pos - 8:box_end])
+        elif (box_type == b'stts' and _u32(buf, pos + 4)) or (box_type == b'stsz' and _u32(buf, pos + 8)):
+            # 分片文件的 moov 里不应有采样，否则说明是普通 MP4
+            raise RemuxUnsupported("不是分片 MP4")
+
+
+def _parse_elst(buf, pos):
+    version, _ = _version_flags(buf, pos)
+    count = _u32(buf, pos + 4)
+    fmt = '>QqhH' if version == 1 else '>IihH'
+    size = struct.calcsize(fmt)
+    return [struct.unpack_from(fmt, buf, pos + 8 + i * size) for i in range(count)]
+
+
+def _parse_moof(buf, moof_start, start, end, track, file_size):
+    trafs = [(pos, box_end) for box_type, pos, box_end in iter_boxes(buf, start, end) if box_type == b'traf']
+    if len(trafs) != 1:
+        raise RemuxUnsupported(f"片段中包含 {len(trafs)} 个 traf")
+
+    _, default_duration, default_size, default_flags = track.defaults
+    base = moof_start
+    decode_time = None
+    data_end = None
+    for box_type, pos, box_end in iter_boxes(buf, *trafs[0]):
+        if box_type == b'tfhd':
+            _, flags = _version_flags(buf, pos)
+            if _u32(buf, pos + 4) != track.track_id:
+                raise RemuxUnsupported("片段的轨道编号与 moov 不一致")
+            if flags & TFHD_BASE_DATA_OFFSET:
+                raise RemuxUnsupported("使用了绝对数据偏移")
+            p = pos + 8
+            if flags & TFHD_SAMPLE_DESCRIPTION_INDEX:
+                if _u32(buf, p) != 1:
+                    raise RemuxUnsupported("使用了多个采样描述")
+                p += 4
+            if flags & TFHD_DEFAULT_DURATION:
+                default_duration = _u32(buf, p)
+                p += 4
+            if flags & TFHD_DEFAULT_SIZE:
+                default_size = _u32(buf, p)
+                p += 4
+            if flags & TFHD_DEFAULT_FLAGS:
+                default_flags = _u32(buf, p)
+        elif box_type == b'tfdt':
+            version, _ = _version_flags(buf, pos)
+            decode_time = struct.unpack_from('>Q' if version == 1 else '>I', buf, pos + 4)[0]
+            if decode_time != track.duration:
+                raise RemuxUnsupported("片段的解码时间不连续")
+        elif box_type == b'trun':
+            if decode_time is None:
+                raise RemuxUnsupported("片段缺少 tfdt")
+            version, flags = _version_flags(buf, pos)
+            count = _u32(buf, pos + 4)
+            p = pos + 8
+            if flags & TRUN_DATA_OFFSET:
+                data_start = base + struct.unpack_from('>i', buf, p)[0]
+                p += 4
+            elif data_end is not None:
+                data_start = data_end
+            else:
+                raise RemuxUnsupported("trun 缺少数据偏移")
+            first_flags = None
+            if flags & TRUN_FIRST_SAMPLE_FLAGS:
+                first_flags = _u32(buf, p)
+                p += 4
+
+            fields = [bit for bit in (TRUN_DURATION, TRUN_SIZE, TRUN_FLAGS, TRUN_CTS) if flags & bit]
+            fmt = '>' + ''.join('i' if bit == TRUN_CTS and version == 1 else 'I' for bit in fields)
+            record = struct.calcsize(fmt)
+            if p + count * record > box_end:
+                raise RemuxUnsupported("trun 数据不完整")
+            chunk_time = track.duration
+            chunk_size = 0
+            for i, values in enumerate(struct.iter_unpack(fmt, buf[p:p + count * record])):
+                sample = dict(zip(fields, values))
+                size = sample.get(TRUN_SIZE, default_size)
+                sample_flags = sample.get(TRUN_FLAGS, first_flags if i == 0 and first_flags is not None else default_flags)
+                duration = sample.get(TRUN_DURATION, default_duration)
+                track.durations.append(duration)
+                track.duration += duration
+                track.sizes.append(size)
+                track.sync.append(not sample_flags & SAMPLE_NON_SYNC)
+                track.cts.append(sample.get(TRUN_CTS, 0))
+                chunk_size += size
+
+            data_end = data_start + chunk_size
+            if data_start < moof_start or data_end > file_size:
+                # 缓存没有下载完整时最后一段数据会越过文件末尾
+                raise RemuxUnsupported("媒体数据超出文件范围")
+            if count:
+                track.chunks.append((data_start, chunk_size, count, chunk_time))
+
+
+def _parse_source(buf, file_size, track):
+    boxes = iter_boxes(buf, track.header_size, file_size)
+    first = next(boxes, None)
+    if first is None or first[0] not in (b'ftyp', b'styp'):
+        raise RemuxUnsupported("缺少 ftyp")
+
+    has_moov = False
+    for box_type, pos, box_end in boxes:
+        if box_type == b'moov':
+            _parse_moov(buf, pos, box_end, track)
+            has_moov = True
+        elif box_type == b'moof':
+            if not has_moov:
+                raise RemuxUnsupported("moof 出现在 moov 之前")
+            # trun 的数据偏移相对于 moof 的起点（moof 不会大到使用 64 位长度）
+            _parse_moof(buf, pos - 8, pos, box_end, track, file_size)
+
+    if not has_moov or track.timescale is None or track.stsd is None:
+        raise RemuxUnsupported("缺少 moov")
+    if track.tkhd_tail is None or track.hdlr is None:
+        # moov 里缺了 tkhd/hdlr 时没法重建 trak，多半是文件损坏
+        raise RemuxUnsupported("moov 不完整")
+    if not track.chunks:
+        raise RemuxUnsupported("没有媒体数据")
+
+
+def _box(box_type, *parts):
+    payload = b''.join(parts)
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def _full_box(box_type, version, flags, *parts):
+    return _box(box_type, struct.pack('>I', (version << 24) | flags), *parts)
+
+
+def _runs(values):
+    """把连续相同的值合并为 [(次数, 值), ...]"""
+    runs = []
+    for value in values:
+        if runs and runs[-1][1] == value:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, value])
+    return runs
+
+
+def _build_stbl(track, chunk_offsets):
+    stts_runs = _runs(track.durations)
+    parts = [
+        track.stsd,
+        _full_box(b'stts', 0, 0, struct.pack('>I', len(stts_runs)),
+                  b''.join(struct.pack('>II', n, d) for n, d in stts_runs)),
+    ]
+
+    if any(track.cts):
+        ctts_runs = _runs(track.cts)
+        version = 1 if any(c < 0 for c in track.cts) else 0
+        fmt = '>Ii' if version == 1 else '>II'
+        parts.append(_full_box(b'ctts', version, 0, struct.pack('>I', len(ctts_runs)),
+                               b''.join(struct.pack(fmt, n, c) for n, c in ctts_runs)))
+
+    if not all(track.sync):
+        sync_samples = [i + 1 for i, sync in enumerate(track.sync) if sync]
+        parts.append(_full_box(b'stss', 0, 0, struct.pack(f'>I{len(sync_samples)}I', len(sync_samples), *sync_samples)))
+
+    stsc_runs = []
+    for index, (_, _, count, _) in enumerate(track.chunks, start=1):
+        if not stsc_runs or stsc_runs[-1][1] != count:
+            stsc_runs.append((index, count))
+    parts.append(_full_box(b'stsc', 0, 0, struct.pack('>I', len(stsc_runs)),
+                           b''.join(struct.pack('>III', first, count, 1) for first, count in stsc_runs)))
+
+    sizes = track.sizes
+    if len(set(sizes)) == 1:
+        parts.append(_full_box(b'stsz', 0, 0, struct.pack('>II', sizes[0], len(sizes))))
+    else:
+        parts.append(_full_box(b'stsz', 0, 0, struct.pack(f'>II{len(sizes)}I', 0, len(sizes), *sizes)))
+
+    if chunk_offsets and max(chunk_offsets) > 0xFFFFFFFF:
+        parts.append(_full_box(b'co64', 0, 0, struct.pack(f'>I{len(chunk_offsets)}Q', len(chunk_offsets), *chunk_offsets)))
+    else:
+        parts.append(_full_box(b'stco', 0, 0, struct.pack(f'>I{len(chunk_offsets)}I', len(chunk_offsets), *chunk_offsets)))
+    return _box(b'stbl', *parts)
+
+
+def _build_trak(track, track_id, chunk_offsets):
+    movie_duration = track.movie_duration
+    if movie_duration > 0xFFFFFFFF or track.duration > 0xFFFFFFFF:
+        tkhd = _full_box(b'tkhd', 1, 3, struct.pack('>QQIIQ', 0, 0, track_id, 0, movie_duration), track.tkhd_tail)
+        mdhd = _full_box(b'mdhd', 1, 0, struct.pack('>QQIQHH', 0, 0, track.timescale, track.duration, track.language, 0))
+    else:
+        tkhd = _full_box(b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, track_id, 0, movie_duration), track.tkhd_tail)
+        mdhd = _full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, track.timescale, track.duration, track.language, 0))
+
+    parts = [tkhd]
+    elst = track.elst
+    if not elst and any(track.cts):
+        # 有 B 帧时第一帧的显示时间晚于 0，和 ffmpeg 一样用编辑列表把它对齐到 0，否则音画会错开
+        decode_time = 0
+        first_pts = None
+        for duration, cts in zip(track.durations, track.cts):
+            pts = decode_time + cts
+            first_pts = pts if first_pts is None else min(first_pts, pts)
+            decode_time += duration
+        if first_pts:
+            elst = [(0, first_pts, 1, 0)]
+    if elst:
+        # 编辑列表的段时长以 mvhd 的时间刻度计，换算到输出的毫秒刻度；单段且时长为 0 时取整条轨道
+        entries = []
+        for segment_duration, media_time, rate, fraction in elst:
+            if segment_duration == 0 and len(elst) == 1:
+                segment_duration = movie_duration
+            elif track.movie_timescale:
+                segment_duration = segment_duration * MOVIE_TIMESCALE // track.movie_timescale
+            entries.append(struct.pack('>QqhH', segment_duration, media_time, rate, fraction))
+        parts.append(_box(b'edts', _full_box(b'elst', 1, 0, struct.pack('>I', len(entries)), *entries)))
+
+    minf = [track.media_header] if track.media_header else []
+    minf += [track.dinf, _build_stbl(track, chunk_offsets)] if track.dinf else [_build_stbl(track, chunk_offsets)]
+    parts.append(_box(b'mdia', mdhd, track.hdlr, _box(b'minf', *minf)))
+    return _box(b'trak', *parts)
+
+
+def _build_moov(tracks, chunk_offsets):
+    duration = max(track.movie_duration for track in tracks)
+    matrix = struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+    tail = struct.pack('>IH10x', 0x00010000, 0x0100) + matrix + bytes(24) + struct.pack('>I', len(tracks) + 1)
+    if duration > 0xFFFFFFFF:
+        mvhd = _full_box(b'mvhd', 1, 0, struct.pack('>QQIQ', 0, 0, MOVIE_TIMESCALE, duration), tail)
+    else:
+        mvhd = _full_box(b'mvhd', 0, 0, struct.pack('>IIII', 0, 0, MOVIE_TIMESCALE, duration), tail)
+    traks = [_build_trak(track, i, offsets) for i, (track, offsets) in enumerate(zip(tracks, chunk_offsets), start=1)]
+    return _box(b'moov', mvhd, *traks)
+
+
+def _copy_range(src, buf, dst, offset, length, state, check_cancel):
+    """把源文件 [offset, offset + length) 复制到 dst 当前位置，优先使用内核的 copy_file_range"""
+    while length > 0:
+        if check_cancel is not None:
+            check_cancel()
+        n = min(length, COPY_CHUNK_SIZE)
+        copied = 0
+        if state.get('copy_file_range', hasattr(os, 'copy_file_range')):
+            try:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), n, offset)
+            except OSError:
+                state['copy_file_range'] = False
+        if not copied:
+            copied = dst.write(buf[offset:offset + n])
+        offset += copied
+        length -= copied
+
+
+class _PipelinedWriter:
+    """源文件和输出不在同一块磁盘时使用：后台线程写出数据块，主线程同时读取下一块，两块磁盘并行工作"""
+
+    def __init__(self, out, depth=PIPELINE_DEPTH):
+        self._out = out
+        self._queue = queue.Queue(depth)
+        self._error = None
+        self._discard = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            if self._error is not None or self._discard:
+                continue
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[self._out.write(view):]
+            except Exception as e:
+                self._error = e
+
+    def copy(self, src, offset, length, check_cancel=None):
+        """读取源文件 [offset, offset + length) 并排队写出，队列满时等待写入跟上"""
+        while length > 0:
+            if check_cancel is not None:
+                check_cancel()
+            if self._error is not None:
+                raise self._error
+            src.seek(offset)
+            data = src.read(min(length, COPY_CHUNK_SIZE))
+            if not data:
+                raise OSError(f"源文件在读取过程中被截断：{src.name}")
+            self._queue.put(data)
+            offset += len(data)
+            length -= len(data)
+
+    def close(self, discard=False):
+        """等待排队的数据写完；discard 为 True 时（出错或取消）丢弃尚未写出的数据"""
+        self._discard = discard
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None and not discard:
+            raise self._error
+
+
+def _plan_output(tracks):
+    """按解码时间排好所有 chunk 并生成文件头，返回 (chunk 顺序, mdat 头, ftyp, moov)"""
+    # 按解码时间交错排列所有 chunk，播放时音视频数据相邻，读取不必来回跳转
+    order = sorted(
+        ((chunk[3] / track.timescale, t, c) for t, (track, _, _) in enumerate(tracks)
+         for c, chunk in enumerate(track.chunks)),
+        key=lambda item: (item[0], item[1])
+    )
+    mdat_size = sum(tracks[t][0].chunks[c][1] for _, t, c in order)
+    large = mdat_size + 8 > 0xFFFFFFFF
+    mdat_header = struct.pack('>I4sQ', 1, b'mdat', mdat_size + 16) if large else struct.pack('>I4s', mdat_size + 8, b'mdat')
+
+    ftyp = _box(b'ftyp', b'isom', struct.pack('>I', 0x200), b'isom', b'iso2', b'mp41')
+    relative = [[0] * len(track.chunks) for track, _, _ in tracks]
+    position = 0
+    for _, t, c in order:
+        relative[t][c] = position
+        position += tracks[t][0].chunks[c][1]
+
+    # chunk 偏移取决于 moov 的大小，而 moov 的大小又取决于用 stco 还是 co64，重复构建直到大小不再变化
+    moov = b''
+    while True:
+        base = len(ftyp) + len(moov) + len(mdat_header)
+        rebuilt = _build_moov([track for track, _, _ in tracks], [[base + r for r in offsets] for offsets in relative])
+        if len(rebuilt) == len(moov):
+            return order, mdat_header, ftyp, rebuilt
+        moov = rebuilt
+
+
+def remux_fmp4(sources, output_path, check_cancel=None, on_progress=None):
+    """把 sources 中的分片 MP4 合并为 output_path。
+
+    sources 为 [(文件路径, 填充头长度), ...]，每个文件只能有一条轨道，输出的轨道顺序与之相同。
+    moov 写在文件开头（可边下边播），各轨道的数据按解码时间交错写入 mdat。
+    check_cancel 会在复制每个数据块前调用，可抛出异常来中止合并。
+    on_progress(已写出字节数, 已写到的秒数) 在每个 chunk 写完后调用。
+    output_path 与源文件不在同一块磁盘时，读取和写入在两个线程中重叠进行，直接写到目标位置。
+    """
+    files = []
+    try:
+        tracks = []
+        for path, header_size in sources:
+            f = open(path, 'rb')
+            files.append(f)
+            file_size = os.fstat(f.fileno()).st_size
+            if file_size <= header_size:
+                raise RemuxUnsupported(f"文件为空：{path}")
+            buf = mmap.mmap(f.fileno(), file_size, access=mmap.ACCESS_READ)
+            files.append(buf)
+            track = _Track(path, header_size)
+            try:
+                _parse_source(buf, file_size, track)
+            except (struct.error, IndexError, ValueError, ZeroDivisionError) as e:
+                # 损坏的文件可能让解析越界或得到不合理的数值，同样交给 ffmpeg 处理
+                raise RemuxUnsupported(f"无法解析 {path}：{e}") from e
+            tracks.append((track, f, buf))
+
+        try:
+            order, mdat_header, ftyp, moov = _plan_output(tracks)
+        except (struct.error, IndexError, ValueError, ZeroDivisionError, OverflowError) as e:
+            raise RemuxUnsupported(f"无法生成 moov：{e}") from e
+
+        state = {}
+        with open(output_path, 'wb', buffering=0) as out:
+            out.write(ftyp)
+            out.write(moov)
+            out.write(mdat_header)
+            written = len(ftyp) + len(moov) + len(mdat_header)
+            output_device = os.fstat(out.fileno()).st_dev
+            writer = None
+            if any(os.fstat(src.fileno()).st_dev != output_device for _, src, _ in tracks):
+                writer = _PipelinedWriter(out)
+            try:
+                for seconds, t, c in order:
+                    track, src, buf = tracks[t]
+                    offset, length, _, _ = track.chunks[c]
+                    if writer is not None:
+                        writer.copy(src, offset, length, check_cancel)
+                    else:
+                        _copy_range(src, buf, out, offset, length, state, check_cancel)
+                    written += length
+                    if on_progress is not None:
+                        on_progress(written, seconds)
+            except BaseException:
+                if writer is not None:
+                    writer.close(discard=True)
+                raise
+            if writer is not None:
+                writer.close()
+    finally:
+        for f in reversed(files):
+            f.close()
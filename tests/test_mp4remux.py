@@ -0,0 +1,141 @@
+"""内置 fMP4 合并：用 ffmpeg 生成一对带填充头的分片 MP4，合并后检查结构、采样表和时间戳"""
+import mmap
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+import mp4remux
+from mp4box import check_mp4, iter_boxes
+
+FFMPEG = shutil.which('ffmpeg')
+HEADER = b'000000000'
+MOVFLAGS = ['-movflags', 'frag_keyframe+empty_moov+default_base_moof+global_sidx', '-f', 'mp4']
+
+pytestmark = pytest.mark.skipif(FFMPEG is None, reason="需要 ffmpeg 生成测试用的分片 MP4")
+
+
+def ffmpeg(*args):
+    subprocess.run([FFMPEG, '-y', '-v', 'error', *args], check=True, stdin=subprocess.DEVNULL)
+
+
+def packets(path, stream):
+    """ffmpeg 读出的各个包：(dts, pts, 大小, 校验值)。
+
+    不比较时长：ffmpeg 读分片 MP4 时最后一个包总是报告默认时长，而 trun 里记录的是实际时长，两者可能不同。
+    """
+    result = subprocess.run(
+        [FFMPEG, '-v', 'error', '-i', str(path), '-map', f'0:{stream}', '-c', 'copy', '-f', 'framecrc', '-'],
+        check=True, capture_output=True, text=True, stdin=subprocess.DEVNULL
+    )
+    return [tuple(line.split(',')[i].strip() for i in (1, 2, 4, 5))
+            for line in result.stdout.splitlines() if line and not line.startswith('#')]
+
+
+def find_boxes(buf, start, end, path):
+    """按路径（例如 moov/trak）找出所有匹配的 box，返回 [(内容起点, 终点), ...]"""
+    found = [(start, end)]
+    for box_type in path:
+        found = [(pos, box_end) for s, e in found
+                 for t, pos, box_end in iter_boxes(buf, s, e) if t == box_type]
+    return found
+
+
+@pytest.fixture(scope='module')
+def fragments(tmp_path_factory):
+    """3 秒带 B 帧的视频和音频；返回 (原始分片, 加了填充头的缓存)"""
+    work = tmp_path_factory.mktemp('fmp4')
+    video, audio = work / 'video.mp4', work / 'audio.mp4'
+    ffmpeg('-f', 'lavfi', '-i', 'testsrc=size=160x120:rate=25', '-t', '3', '-c:v', 'libx264', '-preset', 'veryfast',
+           '-g', '25', '-bf', '2', '-pix_fmt', 'yuv420p', *MOVFLAGS, str(video))
+    ffmpeg('-f', 'lavfi', '-i', 'sine=sample_rate=44100', '-t', '3', '-c:a', 'aac', '-b:a', '64k', *MOVFLAGS, str(audio))
+    cached = []
+    for source in (video, audio):
+        target = work / (source.stem + '.m4s')
+        target.write_bytes(HEADER + source.read_bytes())
+        cached.append(target)
+    return (video, audio), cached
+
+
+def parse(path, header_size):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        track = mp4remux._Track(str(path), header_size)
+        mp4remux._parse_source(buf, len(buf), track)
+    return track
+
+
+def test_remux_keeps_duration_and_tracks(fragments, tmp_path):
+    _, (video, audio) = fragments
+    output = tmp_path / 'out.mp4'
+    mp4remux.remux_fmp4([(str(video), len(HEADER)), (str(audio), len(HEADER))], str(output))
+
+    duration, tracks = check_mp4(str(output))
+    assert tracks == 2
+    assert duration == pytest.approx(3.0, abs=0.1)
+
+
+def test_remux_rebuilds_samples_and_timestamps(fragments, tmp_path):
+    (raw_video, raw_audio), (video, audio) = fragments
+    output = tmp_path / 'out.mp4'
+    mp4remux.remux_fmp4([(str(video), len(HEADER)), (str(audio), len(HEADER))], str(output))
+
+    # trun 中每个采样的时长、大小和 ctts 偏移都写进了采样表，ffmpeg 读出的包应与原始分片一致
+    for stream, raw in enumerate((raw_video, raw_audio)):
+        expected = packets(raw, 0)
+        assert expected
+        assert packets(output, stream) == expected
+
+    data = output.read_bytes()
+    traks = find_boxes(data, 0, len(data), [b'moov', b'trak'])
+    assert len(traks) == 2
+    for (start, end), source, raw in zip(traks, (video, audio), (raw_video, raw_audio)):
+        track = parse(source, len(HEADER))
+        stbl = find_boxes(data, start, end, [b'mdia', b'minf', b'stbl'])[0]
+        [(pos, _)] = find_boxes(data, *stbl, [b'stsz'])
+        assert struct.unpack_from('>I', data, pos + 8)[0] == len(packets(raw, 0)) == len(track.sizes)
+        # stts 展开后应逐个等于 trun 中的采样时长，包括不满一帧的最后一个音频采样
+        [(pos, _)] = find_boxes(data, *stbl, [b'stts'])
+        runs = struct.unpack_from('>I', data, pos + 4)[0]
+        durations = []
+        for count, duration in struct.iter_unpack('>II', data[pos + 8:pos + 8 + runs * 8]):
+            durations += [duration] * count
+        assert durations == track.durations
+
+    # 视频有 B 帧，必须带 ctts；音频没有
+    video_stbl, audio_stbl = (find_boxes(data, s, e, [b'mdia', b'minf', b'stbl'])[0] for s, e in traks)
+    assert find_boxes(data, *video_stbl, [b'ctts'])
+    assert not find_boxes(data, *audio_stbl, [b'ctts'])
+
+
+def test_moov_switches_to_co64_for_large_mdat(fragments):
+    _, (video, audio) = fragments
+    tracks = [(parse(path, len(HEADER)), None, None) for path in (video, audio)]
+    small_moov = mp4remux._plan_output(tracks)[3]
+    assert find_boxes(small_moov, 0, len(small_moov), [b'moov', b'trak', b'mdia', b'minf', b'stbl', b'stco'])
+
+    # 只放大 chunk 的字节数，让 mdat 超过 4 GiB，后面的 chunk 偏移需要 64 位
+    track = tracks[0][0]
+    track.chunks = [(offset, size + 0x80000000, count, time) for offset, size, count, time in track.chunks]
+    order, mdat_header, ftyp, moov = mp4remux._plan_output(tracks)
+
+    assert len(mdat_header) == 16
+    offsets = []
+    co64_chunks = 0
+    for start, end in find_boxes(moov, 0, len(moov), [b'moov', b'trak']):
+        stbl = find_boxes(moov, start, end, [b'mdia', b'minf', b'stbl'])[0]
+        [(pos, _)] = find_boxes(moov, *stbl, [b'co64']) or find_boxes(moov, *stbl, [b'stco'])
+        large = moov[pos - 4:pos] == b'co64'
+        count = struct.unpack_from('>I', moov, pos + 4)[0]
+        offsets.append(struct.unpack_from(f'>{count}{"Q" if large else "I"}', moov, pos + 8))
+        # 每条轨道单独选择：有偏移超过 32 位时才用 co64
+        assert large == (max(offsets[-1]) > 0xFFFFFFFF)
+        co64_chunks += count if large else 0
+    assert co64_chunks
+
+    # co64 每项比 stco 多 4 字节，moov 的大小必须收敛到这个值，chunk 偏移才指向 mdat 中正确的位置
+    assert len(moov) == len(small_moov) + 4 * co64_chunks
+    position = len(ftyp) + len(moov) + len(mdat_header)
+    for _, t, c in order:
+        assert offsets[t][c] == position
+        position += tracks[t][0].chunks[c][1]
@@ -0,0 +1,31 @@
+"""多个缓存目录中有同名子目录时，scan_library 选用完整的那份缓存"""
+import os
+
+from bili_core import scan_library
+
+
+def write_copy(root, name, sizes):
+    folder = os.path.join(root, name)
+    os.makedirs(folder, exist_ok=True)
+    for stream, size in sizes.items():
+        with open(os.path.join(folder, f"{name}-1-{stream}.m4s"), 'wb') as f:
+            f.write(b'0' * size)
+    return folder
+
+
+def test_truncated_copy_in_first_root_does_not_hide_complete_one(tmp_path):
+    write_copy(tmp_path / 'a', '6001', {'30080': 100, '30280': 10})
+    complete = write_copy(tmp_path / 'b', '6001', {'30080': 100, '30280': 50})
+
+    [folder] = scan_library(f"{tmp_path / 'a'};{tmp_path / 'b'}")
+    assert folder.path == complete
+    assert folder.shadowed == [str(tmp_path / 'a' / '6001')]
+
+
+def test_copy_with_both_streams_beats_larger_partial_copy(tmp_path):
+    write_copy(tmp_path / 'a', '6002', {'30080': 500})
+    complete = write_copy(tmp_path / 'b', '6002', {'30080': 100, '30280': 50})
+
+    [folder] = scan_library(f"{tmp_path / 'a'};{tmp_path / 'b'}")
+    assert folder.path == complete
+
@@ -0,0 +1,97 @@
+"""监视模式下分P合集的各分P在不同轮次下载完成时，仍然一起交给合并流程"""
+import json
+import os
+
+import pytest
+
+import bili_core
+from bili_core import LibraryIndex, StabilityTracker, detect_series, scan_library, with_series_parts
+
+
+def write_part(root, name, number, streams):
+    folder = os.path.join(root, name)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, 'videoInfo.json'), 'w', encoding='utf-8') as f:
+        json.dump({'title': f"第{number}集", 'groupId': 42, 'groupTitle': "合集", 'p': number}, f, ensure_ascii=False)
+    for stream in streams:
+        with open(os.path.join(folder, f"{name}-1-{stream}.m4s"), 'wb') as f:
+            f.write(b'0' * 64)
+
+
+def poll(root, tracker):
+    snapshot = scan_library(str(root))
+    ready, waiting = tracker.check(snapshot)
+    if ready:
+        ready = with_series_parts(ready, snapshot, tracker)
+    return snapshot, sorted(os.path.basename(folder.path) for folder in ready), waiting
+
+
+def test_parts_finishing_in_different_polls_are_merged_together(tmp_path):
+    write_part(tmp_path, '1001', 1, ['30080', '30280'])
+    # 第二集只下载出了视频流，而且还在增长
+    write_part(tmp_path, '1002', 2, ['30080'])
+    tracker = StabilityTracker(settle_checks=2)
+
+    for _ in range(4):
+        _, ready, waiting = poll(tmp_path, tracker)
+        assert ready == []
+        assert waiting > 0
+        with open(os.path.join(tmp_path, '1002', '1002-1-30080.m4s'), 'ab') as f:
+            f.write(b'0' * 64)
+
+    write_part(tmp_path, '1002', 2, ['30280'])
+    results = [poll(tmp_path, tracker)[1:] for _ in range(3)]
+    assert [ready for ready, _ in results] == [[], [], ['1001', '1002']]
+    assert results[0][1] > 0
+
+    series = detect_series(scan_library(str(tmp_path)))
+    assert len(series) == 1
+    assert [number for number, _, _ in series[0].parts] == [1, 2]
+
+
+def test_single_folder_is_not_held_back(tmp_path):
+    write_part(tmp_path, '2001', 1, ['30080', '30280'])
+    with open(os.path.join(tmp_path, '2001', 'videoInfo.json'), 'w', encoding='utf-8') as f:
+        json.dump({'title': "单个视频"}, f)
+    tracker = StabilityTracker(settle_checks=2)
+
+    results = [poll(tmp_path, tracker)[1] for _ in range(3)]
+    assert results == [[], [], ['2001']]
+
+
+def test_sibling_stuck_with_one_stream_does_not_block_forever(tmp_path):
+    write_part(tmp_path, '3001', 1, ['30080', '30280'])
+    write_part(tmp_path, '3002', 2, ['30080'])
+    tracker = StabilityTracker(settle_checks=2, incomplete_checks=5)
+
+    results = [poll(tmp_path, tracker)[1] for _ in range(7)]
+    assert results[:5] == [[]] * 5
+    assert ['3001'] in results[5:]
+
+
+def test_series_output_goes_into_first_part_folder(tmp_path):
+    write_part(tmp_path, '4001', 1, ['30080', '30280'])
+    write_part(tmp_path, '4002', 2, ['30080', '30280'])
+
+    [series] = detect_series(scan_library(str(tmp_path)))
+    assert os.path.dirname(series.output_file) == os.path.join(str(tmp_path), '4001')
+
+    [series] = detect_series(scan_library(str(tmp_path)), str(tmp_path / 'out'))
+    assert os.path.dirname(series.output_file) == str(tmp_path / 'out')
+
+
+def test_index_keeps_video_info_between_scans(tmp_path, monkeypatch):
+    root = tmp_path / 'cache'
+    write_part(root, '5001', 1, ['30080', '30280'])
+    write_part(root, '5002', 2, ['30080', '30280'])
+    index = LibraryIndex(str(tmp_path / 'library.db'))
+    scan_library(str(root), index)
+    index.close()
+
+    # 文件没有变化时分P信息取自索引，不再读取 videoInfo.json
+    monkeypatch.setattr(bili_core, 'open', lambda *args, **kwargs: pytest.fail("重新读取了 videoInfo.json"), raising=False)
+    index = LibraryIndex(str(tmp_path / 'library.db'))
+    snapshot = scan_library(str(root), index)
+    index.close()
+    [series] = detect_series(snapshot)
+    assert [number for number, _, _ in series.parts] == [1, 2]
@@ -1,17 +1,32 @@
+"""图形界面入口（PyQt6）。
+
+界面类都继承自 Qt 的类型，因此本文件在开头直接导入 PyQt6；合并流程全部在不依赖 Qt 的 bili_core 中，
+脚本和无界面的服务器请导入 bili_core 或使用 python -m bili_cli，不要导入本文件。
+"""
 import os
-import shutil
 import configparser
-import subprocess
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QPushButton,
-    QFileDialog, QLabel, QScrollArea, QGridLayout, QFrame, QHBoxLayout,
-    QMessageBox, QProgressBar
+    QFileDialog, QLabel, QListView, QStyledItemDelegate, QStyle, QHBoxLayout,
+    QMessageBox, QProgressBar, QSpinBox, QPlainTextEdit
+)
+from PyQt6.QtGui import QPixmap, QImageReader, QCursor, QIcon, QFont, QColor, QPainter, QPen
+from PyQt6.QtCore import (
+    Qt, QSize, QRect, QRectF, QTimer, QThread, QObject, pyqtSignal, QFileSystemWatcher,
+    QAbstractListModel, QModelIndex
 )
-from PyQt6.QtGui import QPixmap, QCursor, QIcon, QFont, QColor
-from PyQt6.QtCore import Qt, QSize, QTimer
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from bili_core import (
+    MergeCancelled, StabilityTracker, LibraryIndex, RunReport,
+    get_config, get_settings, get_index_path, get_thumbnail_dir, get_report_path, split_video_dirs,
+    scan_library, run_pipeline, with_series_parts, extract_thumbnail, thumbnail_cache_path, format_transfer
+)
+
 STYLE_SHEET = """
 QMainWindow {
     background-color: #f0f4f8;
@@ -35,7 +50,7 @@ QPushButton:pressed {
     background-color: #1f6fb3;
 }
 
-QScrollArea {
+QListView {
     border: 1px solid #d6e4f0;
     background-color: white;
     border-radius: 4px;
@@ -53,129 +68,276 @@ QLabel {
 }
 """
 
-def get_config(config_path='config.ini'):
-    config = configparser.ConfigParser()
-    config.read(config_path, encoding='utf-8')
-    video_dir = config.get('settings', 'video_dir', fallback=None)
-    ffmpeg_path = config.get('settings', 'ffmpeg_path', fallback='ffmpeg')
-    return video_dir, ffmpeg_path
+class MergeWorker(QThread):
+    """在后台线程运行合并流程，通过信号把进度和日志交回界面线程"""
+    progress = pyqtSignal(int, int, str)
+    status = pyqtSignal(str)
+    log = pyqtSignal(str)
+    # 合并阶段按字节汇总的进度（TransferStats）
+    transfer = pyqtSignal(object)
+    # 结果：ok / cancelled / error，以及附带的说明
+    completed = pyqtSignal(str, str)
+
+    def __init__(self, video_dir, ffmpeg_path, settings, index=None, folders=None, library=None, parent=None):
+        super().__init__(parent)
+        self.video_dir = video_dir
+        self.ffmpeg_path = ffmpeg_path
+        self.settings = dict(settings)
+        self.index = index
+        self.cancel_event = threading.Event()
+        # 只处理指定的目录（监视模式），为 None 时扫描整个缓存目录
+        self.folders = folders
+        # 监视模式下最近一次的完整扫描结果，查找重复缓存时用
+        self.library = library
+        # 合并结束后交给预览区直接使用，避免再扫描一遍
+        self.snapshot = None
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        report = RunReport()
+        try:
+            if self.folders is not None:
+                self.snapshot = list(self.folders)
+            else:
+                self.status.emit("🔍 正在扫描缓存目录...")
+                self.snapshot = scan_library(self.video_dir, self.index, self.settings['output_dir'], report)
+            failed = run_pipeline(
+                self.video_dir, self.ffmpeg_path, self.settings,
+                progress_callback=self.progress.emit,
+                status_callback=self.status.emit,
+                log=self.log.emit,
+                cancel_event=self.cancel_event,
+                snapshot=self.snapshot,
+                index=self.index,
+                transfer_callback=self.transfer.emit,
+                report=report,
+                library=self.library
+            )
+        except MergeCancelled:
+            self.completed.emit('cancelled', '')
+        except Exception as e:
+            self.completed.emit('error', str(e))
+        else:
+            self.completed.emit('ok', '\n'.join(failed))
+        finally:
+            self.save_report(report)
 
-def copy_and_rename_m4s(directory):
-    for root, _, files in os.walk(directory):
-        if '1.m4s' in files and '2.m4s' in files:
-            print(f"目录 {root} 已有 1.m4s 和 2.m4s，跳过。")
-            continue
+    def save_report(self, report):
+        """写出本次合并的运行报告，并把各阶段耗时的汇总表输出到日志"""
+        try:
+            report.save(get_report_path() if self.settings['run_report'] else None, self.settings['metrics_file'])
+        except OSError as e:
+            self.log.emit(f"⚠️ 无法写入运行报告：{e}")
+        for line in report.format_summary():
+            self.log.emit(line)
+
+class ThumbnailLoader(QObject):
+    """在线程池中生成缩略图，完成后通过信号通知界面线程替换占位图"""
+    # mp4 路径，缩略图路径（失败时为空字符串）
+    ready = pyqtSignal(str, str)
+
+    def __init__(self, ffmpeg_path, cache_dir, max_workers=2, report=None, parent=None):
+        super().__init__(parent)
+        self.ffmpeg_path = ffmpeg_path
+        self.cache_dir = cache_dir
+        self.report = report
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # 只在界面线程中访问，避免同一视频重复排队
+        self._pending = set()
+
+    def request(self, mp4_path):
+        if mp4_path in self._pending:
+            return
+        self._pending.add(mp4_path)
+        self._executor.submit(self._load, mp4_path)
 
-        m4s_files = [f for f in files if f.endswith('.m4s') and f not in ('1.m4s', '2.m4s')]
-        
-        # 按照文件创建时间排序
-        m4s_files = sorted(
-            m4s_files,
-            key=lambda f: os.path.getctime(os.path.join(root, f))
-        )[:2]
-
-        if len(m4s_files) == 0:
-            print(f"目录 {root} 没有找到可处理的 .m4s 文件，跳过。")
-            continue
-
-        for index, old_name in enumerate(m4s_files, start=1):
-            old_path = os.path.join(root, old_name)
-            new_name = f"{index}.m4s"
-            new_path = os.path.join(root, new_name)
-
-            if os.path.exists(new_path):
-                os.remove(new_path)
-
-            shutil.copy2(old_path, new_path)
-            print(f"复制 {old_name} -> {new_name} 于目录 {root}")
-
-def delete_first_9_bytes(directory):
-    for root, _, files in os.walk(directory):
-        for filename in files:
-            if filename.endswith(('1.m4s', '2.m4s')) and 'delete8' not in filename:
-                original_path = os.path.join(root, filename)
-                new_filename = filename.replace('.m4s', '_delete8.m4s')
-                new_path = os.path.join(root, new_filename)
-
-                if os.path.exists(new_path):
-                    print(f"跳过已存在的文件：{new_path}")
-                    continue
-
-                try:
-                    shutil.copy2(original_path, new_path)
-                    with open(new_path, 'r+b') as f:
-                        content = f.read()
-                        f.seek(0)
-                        f.truncate()
-                        f.write(content[9:])
-                    print(f"成功复制并处理：{new_path}")
-                except Exception as e:
-                    print(f"处理文件时出错：{original_path}")
-                    print(e)
-
-def merge_m4s_to_mp4(base_dir, ffmpeg_path, progress_callback=None):
-    # 获取所有文件夹并按创建时间排序（新视频在前）
-    folders = [(os.path.getctime(os.path.join(base_dir, f)), f) 
-              for f in os.listdir(base_dir) 
-              if os.path.isdir(os.path.join(base_dir, f))]
-    folders.sort(key=lambda x: x[0], reverse=True)  # 按创建时间倒序排序
-    
-    total = len(folders)
-    
-    for i, (ctime, folder_name) in enumerate(folders, start=1):
-        folder_path = os.path.join(base_dir, folder_name)
-        m4s1 = os.path.join(folder_path, "1_delete8.m4s")
-        m4s2 = os.path.join(folder_path, "2_delete8.m4s")
-        output_file = os.path.join(folder_path, f"{folder_name}.mp4")
-
-        if progress_callback:
-            progress_callback(i, total, f"✨ 正在处理: {folder_name}")
-
-        if os.path.isfile(output_file):
-            print(f"⚠️ 文件已存在，跳过合并：{output_file}")
-            continue
-
-        if os.path.isfile(m4s1) and os.path.isfile(m4s2):
-            command = [
-                ffmpeg_path,
-                "-i", m4s1,
-                "-i", m4s2,
-                "-c", "copy",
-                output_file
-            ]
-
-            print(f"Merging: {folder_path}")
-            
-            # 修改这里：添加 creationflags 参数
-            if sys.platform == "win32":
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                result = subprocess.run(
-                    command, 
-                    stdout=subprocess.PIPE, 
-                    stderr=subprocess.PIPE, 
-                    text=True,
-                    startupinfo=startupinfo
-                )
-            else:
-                result = subprocess.run(
-                    command, 
-                    stdout=subprocess.PIPE, 
-                    stderr=subprocess.PIPE, 
-                    text=True
-                )
+    def done(self, mp4_path):
+        self._pending.discard(mp4_path)
 
-            if result.returncode == 0:
-                print(f"✅ 成功合并：{output_file}")
-            else:
-                print(f"❌ 合并失败：{folder_path}\n{result.stderr}")
-        else:
-            print(f"⚠️ 缺少 1_delete8.m4s 或 2_delete8.m4s，{folder_path}")
+    def cached(self, mp4_path):
+        """已生成过的缩略图路径，不存在时返回 None"""
+        try:
+            thumb_path = thumbnail_cache_path(self.cache_dir, mp4_path)
+        except OSError:
+            return None
+        return thumb_path if os.path.isfile(thumb_path) else None
+
+    def _load(self, mp4_path):
+        try:
+            thumb_path = extract_thumbnail(self.ffmpeg_path, mp4_path, self.cache_dir, self.report)
+        except Exception as e:
+            print(f"⚠️ 生成缩略图失败：{mp4_path}\n{e}")
+            thumb_path = None
+        self.ready.emit(mp4_path, thumb_path or '')
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+# 预览卡片和缩略图的显示尺寸
+CARD_SIZE = QSize(220, 200)
+THUMB_SIZE = QSize(200, 120)
+# 内存中最多保留多少张已缩放的缩略图，约 100 KB 一张
+THUMB_CACHE_SIZE = 500
+
+def load_scaled_thumbnail(path):
+    """解码时直接缩小到显示尺寸，不先解出整张原图；读取失败时返回 None"""
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    size = reader.size()
+    if size.isValid():
+        reader.setScaledSize(size.scaled(THUMB_SIZE, Qt.AspectRatioMode.KeepAspectRatio))
+    image = reader.read()
+    if image.isNull():
+        return None
+    return QPixmap.fromImage(image)
+
+class ThumbnailCache:
+    """已缩放缩略图的 LRU 缓存，以 (路径, 修改时间) 为键，缩略图重新生成后自动失效；
+    在多次刷新预览之间保留，只在界面线程中访问"""
+
+    def __init__(self, max_items=THUMB_CACHE_SIZE):
+        self.max_items = max_items
+        self._items = OrderedDict()
+
+    def get(self, path):
+        try:
+            key = (path, os.stat(path).st_mtime_ns)
+        except OSError:
+            return None
+        pix = self._items.get(key)
+        if pix is not None:
+            self._items.move_to_end(key)
+            return pix
+        pix = load_scaled_thumbnail(path)
+        if pix is not None:
+            self._items[key] = pix
+            if len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return pix
+
+class VideoListModel(QAbstractListModel):
+    """预览区的数据模型：视图只为可见的卡片取数据，缩略图在滚动到可见时才加载"""
+    FolderRole = Qt.ItemDataRole.UserRole + 1
+    # 还有几份内容相同的缓存
+    DuplicatesRole = Qt.ItemDataRole.UserRole + 2
+
+    def __init__(self, thumbnail_loader, parent=None):
+        super().__init__(parent)
+        self._loader = thumbnail_loader
+        # 刷新预览（set_folders）时不清空，已缩放的缩略图可以直接复用
+        self._cache = ThumbnailCache()
+        self._folders = []
+        # mp4 路径 -> 行号
+        self._rows = {}
+        # mp4 路径 -> 缩略图文件路径，生成失败时为空字符串
+        self._thumbs = {}
+        # 目录路径 -> 内容相同的其他缓存份数
+        self._duplicates = {}
+        self._placeholder = QPixmap(THUMB_SIZE)
+        self._placeholder.fill(QColor(200, 200, 200))
+
+    def set_folders(self, folders, duplicates=None):
+        self.beginResetModel()
+        self._folders = list(folders)
+        self._duplicates = duplicates or {}
+        self._rows = {f.mp4_path: row for row, f in enumerate(self._folders)}
+        self._thumbs.clear()
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._folders)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        folder = self._folders[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return folder.name
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return folder.mp4_path
+        if role == Qt.ItemDataRole.DecorationRole:
+            return self.thumbnail(folder)
+        if role == self.FolderRole:
+            return folder
+        if role == self.DuplicatesRole:
+            return self._duplicates.get(folder.path, 0)
+        return None
+
+    def thumbnail(self, folder):
+        """已有缩略图时从缓存取出；否则返回占位图并交给后台生成"""
+        thumb_path = self._thumbs.get(folder.mp4_path)
+        if thumb_path is None:
+            thumb_path = folder.thumbnail_path or self._loader.cached(folder.mp4_path)
+            if thumb_path is None:
+                self._loader.request(folder.mp4_path)
+                return self._placeholder
+            self._thumbs[folder.mp4_path] = thumb_path
+        return (self._cache.get(thumb_path) if thumb_path else None) or self._placeholder
+
+    def set_thumbnail(self, mp4_path, thumb_path):
+        row = self._rows.get(mp4_path)
+        if row is None:
+            return
+        # 生成失败时保留占位图，不再反复请求
+        self._thumbs[mp4_path] = thumb_path
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.DecorationRole])
+
+class VideoCardDelegate(QStyledItemDelegate):
+    """绘制预览卡片：缩略图、标题、创建时间和合并状态，不为每个视频创建控件"""
+
+    def sizeHint(self, option, index):
+        return CARD_SIZE
+
+    def paint(self, painter, option, index):
+        folder = index.data(VideoListModel.FolderRole)
+        rect = option.rect
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+
+        hovered = bool(option.state & QStyle.StateFlag.State_MouseOver)
+        painter.setPen(QPen(QColor("#3498db" if hovered else "#e0e8f0")))
+        painter.setBrush(QColor("white"))
+        painter.drawRoundedRect(QRectF(rect).adjusted(0.5, 0.5, -0.5, -0.5), 5, 5)
+
+        thumb_rect = QRect(rect.x() + 10, rect.y() + 10, THUMB_SIZE.width(), THUMB_SIZE.height())
+        pix = index.data(Qt.ItemDataRole.DecorationRole)
+        if pix is not None:
+            target = QRect(0, 0, pix.width(), pix.height())
+            target.moveCenter(thumb_rect.center())
+            painter.drawPixmap(target, pix)
+
+        text_x, text_w = rect.x() + 10, rect.width() - 20
+        font = QFont(option.font)
+        font.setPixelSize(12)
+        font.setBold(True)
+        painter.setFont(font)
+        painter.setPen(QColor("#2c3e50"))
+        painter.drawText(
+            QRect(text_x, rect.y() + 134, text_w, 30),
+            Qt.AlignmentFlag.AlignCenter | Qt.TextFlag.TextWordWrap, folder.name
+        )
+
+        create_time = datetime.fromtimestamp(folder.ctime).strftime('%Y-%m-%d %H:%M:%S')
+        font.setBold(False)
+        font.setPixelSize(10)
+        painter.setFont(font)
+        painter.setPen(QColor("#666"))
+        painter.drawText(QRect(text_x, rect.y() + 164, text_w, 14), Qt.AlignmentFlag.AlignCenter, f"创建时间: {create_time}")
+
+        font.setPixelSize(11)
+        painter.setFont(font)
+        duplicates = index.data(VideoListModel.DuplicatesRole)
+        painter.setPen(QColor("#e67e22" if duplicates else "green"))
+        status = f"✅ 已合并 · 🔁 另有 {duplicates} 份相同缓存" if duplicates else "✅ 已合并"
+        painter.drawText(QRect(text_x, rect.y() + 180, text_w, 16), Qt.AlignmentFlag.AlignCenter, status)
+        painter.restore()
 
 class VideoMergerApp(QMainWindow):
     def __init__(self):
         super().__init__()
-        self.is_first_load = True
         self.setWindowTitle("哔哩哔哩视频合并器 - XY_Blue制作 🌞")
         self.resize(1250, 600)
         self.setStyleSheet(STYLE_SHEET)
@@ -184,6 +346,10 @@ class VideoMergerApp(QMainWindow):
             self.setWindowIcon(QIcon('tubiao.ico'))
 
         self.video_dir, self.ffmpeg_path = get_config()
+        self.settings = get_settings()
+        self.index = LibraryIndex(get_index_path())
+        # 缩略图和预览区的耗时记录，关闭窗口时写入运行报告；每次合并另有自己的报告
+        self.report = RunReport()
 
         self.central_widget = QWidget()
         self.setCentralWidget(self.central_widget)
@@ -222,31 +388,108 @@ class VideoMergerApp(QMainWindow):
         
         self.merge_button = QPushButton("🚀 开始合并")
         self.merge_button.clicked.connect(self.run_merge_process)
+
+        self.cancel_button = QPushButton("⛔ 取消合并")
+        self.cancel_button.clicked.connect(self.cancel_merge_process)
+        self.cancel_button.setVisible(False)
+
+        self.watch_button = QPushButton("👀 自动合并")
+        self.watch_button.setCheckable(True)
+        self.watch_button.setToolTip("监视缓存目录，哔哩哔哩下载完成后自动合并新视频")
+
+        self.jobs_label = QLabel("⚡ 并发数")
+        self.jobs_spin = QSpinBox()
+        self.jobs_spin.setRange(1, max(8, os.cpu_count() or 1))
+        self.jobs_spin.setValue(self.settings['jobs'])
+        self.jobs_spin.setToolTip("同时运行的 ffmpeg 合并进程数")
+        self.jobs_spin.valueChanged.connect(self.set_jobs)
         
         button_layout.addWidget(self.config_button)
         button_layout.addWidget(self.ffmpeg_button)
         button_layout.addWidget(self.merge_button)
+        button_layout.addWidget(self.cancel_button)
+        button_layout.addWidget(self.watch_button)
+        button_layout.addWidget(self.jobs_label)
+        button_layout.addWidget(self.jobs_spin)
         self.layout.addLayout(button_layout)
 
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area_widget = QWidget()
-        self.grid_layout = QGridLayout(self.scroll_area_widget)
-        self.grid_layout.setContentsMargins(5, 5, 5, 5)
-        self.grid_layout.setSpacing(20)
-        self.grid_layout.setAlignment(Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignTop)
-        self.scroll_area.setWidget(self.scroll_area_widget)
-        self.layout.addWidget(self.scroll_area)
-
-        self.video_frames = []
+        self.log_view = QPlainTextEdit()
+        self.log_view.setReadOnly(True)
+        self.log_view.setMaximumBlockCount(2000)
+        self.log_view.setFixedHeight(120)
+        self.log_view.setVisible(False)
+        self.layout.addWidget(self.log_view)
+
+        self.thumbnail_loader = ThumbnailLoader(self.ffmpeg_path, get_thumbnail_dir(), report=self.report, parent=self)
+        self.thumbnail_loader.ready.connect(self.on_thumbnail_ready)
+
+        # 图标模式的列表视图只绘制可见卡片，窗口缩放时自动重新排列
+        self.video_model = VideoListModel(self.thumbnail_loader, self)
+        self.video_view = QListView()
+        self.video_view.setViewMode(QListView.ViewMode.IconMode)
+        self.video_view.setResizeMode(QListView.ResizeMode.Adjust)
+        self.video_view.setMovement(QListView.Movement.Static)
+        self.video_view.setLayoutMode(QListView.LayoutMode.Batched)
+        self.video_view.setUniformItemSizes(True)
+        self.video_view.setSpacing(10)
+        self.video_view.setSelectionMode(QListView.SelectionMode.NoSelection)
+        self.video_view.setMouseTracking(True)
+        self.video_view.viewport().setCursor(QCursor(Qt.CursorShape.PointingHandCursor))
+        self.video_view.setItemDelegate(VideoCardDelegate(self.video_view))
+        self.video_view.setModel(self.video_model)
+        self.video_view.clicked.connect(
+            lambda index: self.open_folder(os.path.dirname(index.data(VideoListModel.FolderRole).mp4_path))
+        )
+        self.layout.addWidget(self.video_view)
+
+        self.empty_label = QLabel("📁 没有找到可合并的视频，请先设置视频目录")
+        self.empty_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.empty_label.setStyleSheet("font-size: 14px; color: #666;")
+        self.layout.addWidget(self.empty_label)
+        self.worker = None
+        self.worker_auto = False
+
+        # 监视模式：目录变化时唤醒轮询，文件大小稳定后才入队合并
+        self.tracker = StabilityTracker()
+        self.watch_queue = []
+        # 最近一次轮询的完整扫描结果
+        self.watch_snapshot = None
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.on_directory_changed)
+        self.watch_timer = QTimer(self)
+        self.watch_timer.setInterval(max(1, self.settings['watch_interval']) * 1000)
+        self.watch_timer.timeout.connect(self.poll_watched_folders)
+
         self.load_previews()
+        self.watch_button.setChecked(self.settings['watch'])
+        self.watch_button.toggled.connect(self.set_watch_enabled)
+        if self.settings['watch']:
+            self.set_watch_enabled(True)
+
+    def video_roots(self):
+        """配置的所有缓存目录，有目录不存在时返回空列表"""
+        roots = split_video_dirs(self.video_dir)
+        return roots if all(os.path.isdir(root) for root in roots) else []
 
     def set_video_dir(self):
-        directory = QFileDialog.getExistingDirectory(self, "选择视频目录", self.video_dir or os.path.expanduser("~"))
+        roots = split_video_dirs(self.video_dir)
+        directory = QFileDialog.getExistingDirectory(self, "选择视频目录", roots[0] if roots else os.path.expanduser("~"))
         if directory:
+            # 已有缓存目录时可以把新目录加进去，多个目录同时扫描和合并
+            combined = split_video_dirs(roots + [directory])
+            if roots and combined != roots:
+                listed = '\n'.join(roots)
+                answer = QMessageBox.question(
+                    self, "添加视频目录",
+                    f"当前的视频目录：\n{listed}\n\n是否保留这些目录并添加所选目录？选择“否”将只使用所选目录。"
+                )
+                if answer == QMessageBox.StandardButton.Yes:
+                    directory = ';'.join(combined)
             self.video_dir = directory
             self.save_config()
             self.load_previews()
+            if self.watch_button.isChecked():
+                self.set_watch_enabled(True)
 
     def set_ffmpeg_path(self):
         """设置FFmpeg路径，不再进行验证"""
@@ -260,15 +503,24 @@ class VideoMergerApp(QMainWindow):
         
         if file_path:
             self.ffmpeg_path = file_path
+            self.thumbnail_loader.ffmpeg_path = file_path
             self.save_config()
             QMessageBox.information(self, "成功", f"FFmpeg路径已设置为:\n{file_path}")
 
+    def set_jobs(self, value):
+        self.settings['jobs'] = value
+        self.save_config()
+
     def save_config(self):
         config = configparser.ConfigParser()
-        config['settings'] = {
-            'video_dir': self.video_dir,
-            'ffmpeg_path': self.ffmpeg_path
-        }
+        # 保留用户手动添加的其他配置项
+        config.read('config.ini', encoding='utf-8')
+        if not config.has_section('settings'):
+            config.add_section('settings')
+        config['settings']['video_dir'] = self.video_dir or ''
+        config['settings']['ffmpeg_path'] = self.ffmpeg_path
+        config['settings']['jobs'] = str(self.settings['jobs'])
+        config['settings']['watch'] = str(self.settings['watch']).lower()
         with open('config.ini', 'w', encoding='utf-8') as f:
             config.write(f)
 
@@ -280,204 +532,209 @@ class VideoMergerApp(QMainWindow):
             QMessageBox.information(self, "提示", "⚠️ config.ini 文件不存在")
 
     def run_merge_process(self):
-        if not self.video_dir or not os.path.isdir(self.video_dir):
+        if not self.video_roots():
             QMessageBox.critical(self, "错误", "❌ 未找到有效的视频目录或目录不存在。请先设置视频目录。")
             return
-            
+        if self.worker is not None and self.worker.isRunning():
+            return
+        self.start_worker()
+
+    def start_worker(self, folders=None):
+        """启动后台合并；folders 为监视模式入队的目录，为 None 时合并整个缓存目录"""
+        self.worker_auto = folders is not None
         self.progress_bar.setVisible(True)
         self.progress_bar.setValue(0)
         self.status_label.setText("🔄 准备开始合并...")
-        QApplication.processEvents()
-        
-        QTimer.singleShot(100, self._run_merge_process)
+        self.progress_message = ""
+        self.transfer_stats = None
+        self.log_view.clear()
+        self.log_view.setVisible(True)
+        self.set_controls_enabled(False)
+
+        library = self.watch_snapshot if folders is not None else None
+        self.worker = MergeWorker(self.video_dir, self.ffmpeg_path, self.settings, self.index, folders, library, self)
+        self.worker.progress.connect(self.update_progress)
+        self.worker.status.connect(self.update_status)
+        self.worker.log.connect(self.append_log)
+        self.worker.transfer.connect(self.update_transfer)
+        self.worker.completed.connect(self.on_merge_finished)
+        self.worker.start()
+
+    def set_watch_enabled(self, enabled):
+        self.settings['watch'] = enabled
+        self.save_config()
+        self.tracker = StabilityTracker()
+        self.watch_queue.clear()
+        watched = self.watcher.directories()
+        if watched:
+            self.watcher.removePaths(watched)
+
+        roots = self.video_roots()
+        if enabled and roots:
+            self.watcher.addPaths(roots)
+            self.watch_timer.start()
+            self.status_label.setText(f"👀 正在监视 {'、'.join(roots)}，下载完成的新视频会自动合并")
+        else:
+            self.watch_timer.stop()
 
-    def _run_merge_process(self):
-        try:
-            self.status_label.setText("🔄 正在复制和重命名m4s文件...")
-            QApplication.processEvents()
-            copy_and_rename_m4s(self.video_dir)
-            
-            self.status_label.setText("🔄 正在处理m4s文件...")
-            QApplication.processEvents()
-            delete_first_9_bytes(self.video_dir)
-            
-            self.status_label.setText("🔄 正在合并视频...")
-            QApplication.processEvents()
-            merge_m4s_to_mp4(self.video_dir, self.ffmpeg_path, self.update_progress)
-            
-            self.status_label.setText("✅ 所有处理完成！")
-            self.progress_bar.setValue(100)
-            QMessageBox.information(
-                self, 
-                "视频已合并", 
-                "🎉【更新的视频见下方左】 😈【若未完成请校验路径和程序】"
-            )
-        except Exception as e:
-            self.status_label.setText(f"❌ 处理出错: {str(e)}")
-            QMessageBox.critical(self, "错误", f"⚠️ 处理过程中发生错误:\n{str(e)}")
-        finally:
-            self.progress_bar.setVisible(False)
+    def on_directory_changed(self, path):
+        # 新目录或新文件出现时恢复轮询，直到所有新缓存都稳定下来
+        if self.watch_button.isChecked() and not self.watch_timer.isActive():
+            self.watch_timer.start()
+
+    def poll_watched_folders(self):
+        roots = self.video_roots()
+        if not roots:
+            return
+        snapshot = scan_library(roots, self.index, self.settings['output_dir'])
+        self.watch_snapshot = snapshot
+        ready, waiting = self.tracker.check(snapshot)
+        if ready and self.settings['concat_series']:
+            # 分P合集由全部分P一起合并，已在队列中的不重复加入
+            queued = {f.path for f in self.watch_queue}
+            ready = [f for f in with_series_parts(ready, snapshot, self.tracker) if f.path not in queued]
+        self.watch_queue.extend(ready)
+
+        # 只监视缓存根目录和尚未合并的目录，已合并的目录不再占用监视句柄
+        wanted = set(roots) | {f.path for f in snapshot if f.state != 'merged'}
+        current = set(self.watcher.directories())
+        if current - wanted:
+            self.watcher.removePaths(list(current - wanted))
+        if wanted - current:
+            self.watcher.addPaths(list(wanted - current))
+
+        if not waiting:
+            self.watch_timer.stop()
+        self.start_queued_merge()
+
+    def start_queued_merge(self):
+        if not self.watch_queue or (self.worker is not None and self.worker.isRunning()):
+            return
+        folders, self.watch_queue = self.watch_queue, []
+        self.start_worker(folders)
+
+    def cancel_merge_process(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.cancel_button.setEnabled(False)
+            self.status_label.setText("⏳ 正在取消，等待 ffmpeg 退出...")
+            self.worker.cancel()
+
+    def set_controls_enabled(self, enabled):
+        for widget in (self.config_button, self.ffmpeg_button, self.merge_button, self.watch_button, self.jobs_spin):
+            widget.setEnabled(enabled)
+        self.cancel_button.setVisible(not enabled)
+        self.cancel_button.setEnabled(not enabled)
+
+    def append_log(self, message):
+        print(message)
+        self.log_view.appendPlainText(message)
+
+    def on_merge_finished(self, result, detail):
+        self.worker.wait()
+        snapshot = self.worker.snapshot
+        self.worker = None
+        self.progress_bar.setVisible(False)
+        self.set_controls_enabled(True)
+
+        if self.worker_auto:
+            # 自动合并不弹窗，只刷新状态和预览，然后继续处理队列中的目录
+            if result == 'ok':
+                failed = detail.split('\n') if detail else []
+                merged = len(snapshot) - len(failed)
+                self.status_label.setText(f"👀 自动合并完成 {merged} 个视频" + (f"，{len(failed)} 个失败" if failed else ""))
+            elif result == 'cancelled':
+                self.status_label.setText("⛔ 自动合并已取消，未完成的文件已清理")
+            else:
+                self.status_label.setText(f"❌ 自动合并出错: {detail}")
             self.load_previews()
+            self.start_queued_merge()
+            return
 
-    def update_progress(self, current, total, message):
-        progress = int((current / total) * 100)
-        self.progress_bar.setValue(progress)
-        self.status_label.setText(message)
-        QApplication.processEvents()
-
-    def get_video_thumbnail(self, mp4_path):
-        folder = os.path.dirname(mp4_path)
-        base = os.path.splitext(os.path.basename(mp4_path))[0]
-
-        for ext in ['jpg', 'png', 'jpeg']:
-            thumb_path = os.path.join(folder, base + '.' + ext)
-            if os.path.isfile(thumb_path):
-                pix = QPixmap(thumb_path)
-                return pix.scaled(200, 120, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
-
-        thumb_path = os.path.join(folder, base + '.jpg')
-        if not os.path.isfile(thumb_path):
-            cmd = [
-                self.ffmpeg_path,
-                '-y',
-                '-i', mp4_path,
-                '-ss', '00:00:05',
-                '-vframes', '1',
-                '-q:v', '2',
-                thumb_path
-            ]
-
-            # 修改这里：添加隐藏窗口的参数
-            if sys.platform == "win32":
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                subprocess.run(
-                    cmd, 
-                    stdout=subprocess.DEVNULL, 
-                    stderr=subprocess.DEVNULL,
-                    startupinfo=startupinfo
+        if result == 'ok':
+            self.status_label.setText("✅ 所有处理完成！")
+            if detail:
+                failed = detail.split('\n')
+                QMessageBox.warning(
+                    self,
+                    "部分视频合并失败",
+                    f"⚠️ 有 {len(failed)} 个目录合并失败，详情见日志:\n" + "\n".join(failed[:10])
                 )
             else:
-                subprocess.run(
-                    cmd, 
-                    stdout=subprocess.DEVNULL, 
-                    stderr=subprocess.DEVNULL
+                QMessageBox.information(
+                    self, 
+                    "视频已合并", 
+                    "🎉【更新的视频见下方左】 😈【若未完成请校验路径和程序】"
                 )
+        elif result == 'cancelled':
+            self.status_label.setText("⛔ 合并已取消，未完成的文件已清理")
+        else:
+            self.status_label.setText(f"❌ 处理出错: {detail}")
+            QMessageBox.critical(self, "错误", f"⚠️ 处理过程中发生错误:\n{detail}")
+        self.load_previews(snapshot)
 
-        if os.path.isfile(thumb_path):
-            pix = QPixmap(thumb_path)
-            return pix.scaled(200, 120, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+    def update_progress(self, current, total, message):
+        self.progress_message = message
+        if self.transfer_stats is None:
+            progress = int((current / total) * 100)
+            self.progress_bar.setValue(progress)
+            self.status_label.setText(message)
+        else:
+            self.status_label.setText(f"{message}   {format_transfer(self.transfer_stats)}")
 
-        default_pix = QPixmap(200, 120)
-        default_pix.fill(QColor(200, 200, 200))
-        return default_pix
+    def update_status(self, message):
+        self.progress_message = message
+        self.status_label.setText(message)
+
+    def update_transfer(self, stats):
+        """合并过程中按已写出的字节数推进进度条，并显示吞吐量和剩余时间"""
+        if self.worker is None:
+            return
+        self.transfer_stats = stats
+        self.progress_bar.setValue(int(stats.fraction * 100))
+        self.status_label.setText(f"{self.progress_message}   {format_transfer(stats)}")
+
+    def on_thumbnail_ready(self, mp4_path, thumb_path):
+        self.thumbnail_loader.done(mp4_path)
+        self.video_model.set_thumbnail(mp4_path, thumb_path)
 
     def open_folder(self, folder_path):
         """打开指定文件夹"""
         if os.path.isdir(folder_path):
             os.startfile(folder_path)
 
-    def load_previews(self):
-        for i in reversed(range(self.grid_layout.count())):
-            widget = self.grid_layout.itemAt(i).widget()
-            if widget:
-                widget.setParent(None)
-        self.video_frames.clear()
-
-        if not self.video_dir or not os.path.isdir(self.video_dir):
-            no_videos_label = QLabel("📁 没有找到可合并的视频，请先设置视频目录")
-            no_videos_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-            no_videos_label.setStyleSheet("font-size: 14px; color: #666;")
-            self.grid_layout.addWidget(no_videos_label, 0, 0, 1, 1)
-            return
-
-        # 获取所有文件夹并按创建时间排序（新视频在前）
-        folders = []
-        for folder in os.listdir(self.video_dir):
-            full_path = os.path.join(self.video_dir, folder)
-            if os.path.isdir(full_path):
-                ctime = os.path.getctime(full_path)
-                folders.append((ctime, folder, full_path))
-        
-        # 按创建时间倒序排序（新视频在前）
-        folders.sort(key=lambda x: x[0], reverse=True)
-        
-        for ctime, folder, full_path in folders:
-            mp4_file = os.path.join(full_path, f"{folder}.mp4")
-            if os.path.isfile(mp4_file):
-                frame = QFrame()
-                frame.setFrameShape(QFrame.Shape.Box)
-                frame.setLineWidth(1)
-                frame.setFixedSize(220, 200)  # 增加高度以容纳创建时间
-                frame.setStyleSheet("QFrame { background-color: white; border-radius: 5px; }")
-                
-                vbox = QVBoxLayout(frame)
-                vbox.setContentsMargins(10, 10, 10, 10)
-                vbox.setSpacing(5)
-                
-                thumb = self.get_video_thumbnail(mp4_file)
-                thumb_label = QLabel()
-                thumb_label.setPixmap(thumb)
-                thumb_label.setFixedSize(200, 120)
-                thumb_label.setScaledContents(True)
-                thumb_label.setCursor(QCursor(Qt.CursorShape.PointingHandCursor))
-                thumb_label.mousePressEvent = lambda e, path=full_path: self.open_folder(path)
-                vbox.addWidget(thumb_label)
-                
-                title_label = QLabel(folder)
-                title_label.setStyleSheet("font-size: 12px; font-weight: bold;")
-                title_label.setWordWrap(True)
-                title_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-                vbox.addWidget(title_label)
-                
-                # 添加创建时间显示
-                create_time = datetime.fromtimestamp(ctime).strftime('%Y-%m-%d %H:%M:%S')
-                time_label = QLabel(f"创建时间: {create_time}")
-                time_label.setStyleSheet("color: #666; font-size: 10px;")
-                time_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-                vbox.addWidget(time_label)
-                
-                status_label = QLabel("✅ 已合并")
-                status_label.setStyleSheet("color: green; font-size: 11px;")
-                status_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-                vbox.addWidget(status_label)
-                
-                self.video_frames.append(frame)
-
-        self.relayout_videos()
-        
-        if self.is_first_load:
-            self.is_first_load = False
-            QTimer.singleShot(100, self.relayout_videos)
-
-    def relayout_videos(self):
-        for i in reversed(range(self.grid_layout.count())):
-            widget = self.grid_layout.itemAt(i).widget()
-            if widget:
-                self.grid_layout.removeWidget(widget)
-
-        if not self.video_frames:
-            no_videos_label = QLabel("📁 没有找到可合并的视频，请先设置视频目录")
-            no_videos_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-            no_videos_label.setStyleSheet("font-size: 14px; color: #666;")
-            self.grid_layout.addWidget(no_videos_label, 0, 0, 1, 1)
-            return
-
-        area_width = self.scroll_area.viewport().width()
-        col_width = 240
-        max_cols = max(1, area_width // col_width)
-
-        row, col = 0, 0
-        for frame in self.video_frames:
-            self.grid_layout.addWidget(frame, row, col)
-            col += 1
-            if col >= max_cols:
-                col = 0
-                row += 1
-
-    def resizeEvent(self, event):
-        super().resizeEvent(event)
-        self.relayout_videos()
+    def load_previews(self, snapshot=None):
+        with self.report.stage('preview', self.video_dir) as timing:
+            merged = []
+            roots = self.video_roots()
+            if roots:
+                # 扫描快照已按创建时间倒序排列（新视频在前），多个缓存目录的视频合并显示
+                if snapshot is None:
+                    snapshot = scan_library(roots, self.index, self.settings['output_dir'], self.report)
+                # 分P合集的各分P指向同一个 mp4，只显示一次
+                shown = set()
+                for f in snapshot:
+                    if f.has_output and f.mp4_path not in shown:
+                        shown.add(f.mp4_path)
+                        merged.append(f)
+            timing['folders'] = len(merged)
+            self.video_model.set_folders(merged, self.index.duplicate_counts())
+        self.video_view.setVisible(bool(merged))
+        self.empty_label.setVisible(not merged)
+
+    def closeEvent(self, event):
+        # 关闭窗口时先停止后台合并，避免留下写了一半的文件
+        self.watch_timer.stop()
+        self.thumbnail_loader.shutdown()
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.cancel()
+            self.worker.wait()
+        self.index.close()
+        if self.settings['run_report'] and self.report.records:
+            try:
+                self.report.save(get_report_path())
+            except OSError as e:
+                print(f"⚠️ 无法写入运行报告：{e}")
+        super().closeEvent(event)
 
 
 if __name__ == "__main__":
@@ -490,4 +747,4 @@ if __name__ == "__main__":
     
     window = VideoMergerApp()
     window.show()
-    sys.exit(app.exec())
\ No newline at end of file
+    sys.exit(app.exec())